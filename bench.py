@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks.
+
+Each benchmark runs on synthetic data (see `synthmap`) at several scales, and
+reports its throughput. Scale 1 is a map with 500 polygons, 25 patches, 25
+meshes, 8 textures and 200 entities, and other scales multiply each of these.
+The ents benchmark uses a map with 10,000 entities per scale instead.
+Fixed-size benchmarks run once, at the first scale, and their results are
+not keyed by scale.
+
+    .. bsp-load:: Loads a BSP, decodes its geometry and builds its mesh.
+    .. ents:: Parses a BSP's entities, after checking that some tricky entity
+        strings are parsed correctly.
+    .. ents-100k:: Parses the entities of a map with 100,000 entities,
+        whatever the scale.
+    .. ents-malformed:: Parses an entity string with a key followed by a long
+        run of whitespace but no value, failing unless it is rejected.
+    .. scene-tris:: Generates the triangles of a `bsp2sdl.BspScene`.
+    .. povray-triangles, povray-mesh2, yafaray, ply, obj:: Write a `BspScene`
+        to the null device. The scene's mesh is built beforehand.
+    .. colors-exact, colors-reduced:: Calculate the colors of textures with
+        `loadcolors.calculate_color`. colors-reduced reports its maximum error,
+        failing if it exceeds `--color-tolerance`.
+    .. fs-threads:: Reads textures from many threads at once, failing if any
+        are read incorrectly.
+
+Throughputs can be saved as a baseline with `--save-baseline`. When a baseline
+has been saved, later runs fail if any throughput falls too far below it.
+
+Note the benchmarks require pillow (or equivalent) to be installed.
+
+"""
+
+
+__all__ = (
+    'main',
+)
+
+
+import argparse
+import collections
+import concurrent.futures
+import functools
+import json
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+import bsp2sdl
+import loadcolors
+import meshfile.obj
+import meshfile.ply
+import povray.sdl
+import q3.bsp
+import q3.ents
+import q3.fs
+import synthmap
+import yafaray.xml
+
+
+_DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(__file__),
+                                      "bench_baseline.json")
+
+# Synthetic map parameters at scale 1.
+_BASE_PARAMS = synthmap.SynthParams(polygons=500, patches=25, meshes=25,
+                                    textures=8, entities=200)
+
+# Number of entities per scale in the ents benchmark's map.
+_ENTS_PER_SCALE = 10000
+
+# Entity strings checked by the ents benchmark, and the entities they should
+# be parsed into.
+_ENTS_CHECKS = [
+    # A trailing backslash, as in a Windows path, does not escape the quote.
+    ('{\n"classname" "worldspawn"\n"path" "C:\\maps\\"\n}\n',
+     [{'classname': 'worldspawn', 'path': 'C:\\maps\\'}]),
+    ('{ "message" "say \\"hi\\" \\\\ bye" }',
+     [{'message': 'say "hi" \\ bye'}]),
+    ('{\n"classname" // comment\n"light"\n}\x00',
+     [{'classname': 'light'}]),
+]
+
+# Number of entities in the ents-100k benchmark's map.
+_ENTS_FIXED = 100000
+
+# Number of characters of whitespace per scale in the ents-malformed
+# benchmark's entity string.
+_MALFORMED_ENTS_SPACES_PER_SCALE = 100000
+
+
+_Result = collections.namedtuple('_Result',
+        ['elapsed', 'count', 'unit', 'note'])
+
+_BENCHMARKS = collections.OrderedDict()
+
+# Names of benchmarks whose data does not depend on the scale.
+_FIXED_SIZE_BENCHMARKS = set()
+
+
+def _benchmark(name, fixed_size=False):
+    """
+    Decorator to register a benchmark function.
+
+    The function is passed a `_Synth` for the scale to run at and the parsed
+    command line arguments, and returns a `_Result`. If `fixed_size` is true
+    the benchmark does the same work at every scale, so is only run once.
+
+    """
+    def decorator(fn):
+        _BENCHMARKS[name] = fn
+        if fixed_size:
+            _FIXED_SIZE_BENCHMARKS.add(name)
+        return fn
+    return decorator
+
+
+class _Synth():
+    """
+    Synthetic data for a scale, generated when first needed.
+
+    """
+
+    def __init__(self, scale, tmp_dir):
+        self.scale = scale
+        self.params = _BASE_PARAMS._replace(
+            **{field: getattr(_BASE_PARAMS, field) * scale
+                   for field in ('polygons', 'patches', 'meshes', 'textures',
+                                 'entities')})
+        self._dir = os.path.join(tmp_dir, str(scale))
+
+    @functools.cached_property
+    def bsp_data(self):
+        return synthmap.make_bsp(self.params)
+
+    @functools.cached_property
+    def ents_bsp_data(self):
+        return synthmap.make_bsp(self.params._replace(
+            entities=_ENTS_PER_SCALE * self.scale))
+
+    @functools.cached_property
+    def ents_fixed_bsp_data(self):
+        return synthmap.make_bsp(self.params._replace(entities=_ENTS_FIXED))
+
+    @functools.cached_property
+    def tex_names(self):
+        return synthmap.write_pk3s(self._dir, self.params)
+
+    def fs(self):
+        """Return a new filesystem holding the textures."""
+        self.tex_names
+        return q3.fs.FileSystem.from_dir(self._dir)
+
+    def scene(self):
+        """Return a new `bsp2sdl.BspScene` of the map, with gray materials."""
+        bsp = q3.bsp.Bsp(self.bsp_data)
+        colors = {tex.name: (0.5, 0.5, 0.5) for tex in bsp.textures}
+        return bsp2sdl.BspScene(bsp, None, colors=colors)
+
+
+@_benchmark("bsp-load")
+def _bench_bsp_load(synth, args):
+    start = time.perf_counter()
+    bsp = q3.bsp.Bsp(synth.bsp_data)
+    bsp.mesh
+    elapsed = time.perf_counter() - start
+
+    return _Result(elapsed=elapsed, count=len(bsp.face_arrays.type),
+                   unit="faces", note="")
+
+
+@_benchmark("ents")
+def _bench_ents(synth, args):
+    for ents_str, expected in _ENTS_CHECKS:
+        ents = q3.ents.parse(ents_str)
+        if ents != expected:
+            raise AssertionError("{!r} parsed as {!r}, not {!r}".format(
+                ents_str, ents, expected))
+
+    bsp = q3.bsp.Bsp(synth.ents_bsp_data)
+    start = time.perf_counter()
+    ents = bsp.entities
+    elapsed = time.perf_counter() - start
+
+    return _Result(elapsed=elapsed, count=len(ents), unit="ents", note="")
+
+
+@_benchmark("ents-100k", fixed_size=True)
+def _bench_ents_100k(synth, args):
+    bsp = q3.bsp.Bsp(synth.ents_fixed_bsp_data)
+    start = time.perf_counter()
+    ents = bsp.entities
+    elapsed = time.perf_counter() - start
+
+    return _Result(elapsed=elapsed, count=len(ents), unit="ents", note="")
+
+
+@_benchmark("ents-malformed")
+def _bench_ents_malformed(synth, args):
+    ents_str = ('{ "key"' + ' ' * (_MALFORMED_ENTS_SPACES_PER_SCALE *
+                                   synth.scale) + '}')
+    start = time.perf_counter()
+    try:
+        q3.ents.parse(ents_str)
+    except q3.ents.BadEntsString:
+        pass
+    else:
+        raise AssertionError("Dangling key was not rejected")
+    elapsed = time.perf_counter() - start
+
+    return _Result(elapsed=elapsed, count=len(ents_str), unit="chars",
+                   note="rejected")
+
+
+@_benchmark("scene-tris")
+def _bench_scene_tris(synth, args):
+    scene = synth.scene()
+    start = time.perf_counter()
+    num_tris = sum(1 for tri in scene.tris)
+    elapsed = time.perf_counter() - start
+
+    return _Result(elapsed=elapsed, count=num_tris, unit="tris", note="")
+
+
+def _time_write(write_fn, synth, mode="w"):
+    scene = synth.scene()
+    num_tris = len(scene.mesh.material_indices)
+    with open(os.devnull, mode) as f:
+        start = time.perf_counter()
+        write_fn(f, scene)
+        elapsed = time.perf_counter() - start
+
+    return _Result(elapsed=elapsed, count=num_tris, unit="tris", note="")
+
+
+@_benchmark("povray-triangles")
+def _bench_povray_triangles(synth, args):
+    return _time_write(
+        lambda f, scene: povray.sdl.write(f, scene, mesh2=False), synth)
+
+
+@_benchmark("povray-mesh2")
+def _bench_povray_mesh2(synth, args):
+    return _time_write(
+        lambda f, scene: povray.sdl.write(f, scene, mesh2=True), synth)
+
+
+@_benchmark("yafaray")
+def _bench_yafaray(synth, args):
+    return _time_write(yafaray.xml.write, synth)
+
+
+@_benchmark("ply")
+def _bench_ply(synth, args):
+    return _time_write(meshfile.ply.write, synth, mode="wb")
+
+
+@_benchmark("obj")
+def _bench_obj(synth, args):
+    return _time_write(meshfile.obj.write, synth)
+
+
+def _time_colors(synth, reduce, tolerance=None):
+    fs = synth.fs()
+    start = time.perf_counter()
+    colors = [loadcolors.calculate_color(fs, tex_name, reduce=reduce)
+                  for tex_name in synth.tex_names]
+    elapsed = time.perf_counter() - start
+
+    note = ""
+    if reduce != 1:
+        exact = [loadcolors.calculate_color(fs, tex_name)
+                     for tex_name in synth.tex_names]
+        max_error = max(abs(a - b) for color, exact_color
+                                       in zip(colors, exact)
+                                   for a, b in zip(color, exact_color))
+        note = "max error {:.4f}".format(max_error)
+        if tolerance is not None and max_error > tolerance:
+            raise Exception("Color error {:.4f} exceeds the tolerance of "
+                            "{}".format(max_error, tolerance))
+
+    return _Result(elapsed=elapsed, count=len(colors), unit="textures",
+                   note=note)
+
+
+@_benchmark("colors-exact")
+def _bench_colors_exact(synth, args):
+    return _time_colors(synth, reduce=1)
+
+
+@_benchmark("colors-reduced")
+def _bench_colors_reduced(synth, args):
+    return _time_colors(synth, reduce=args.color_reduce,
+                        tolerance=args.color_tolerance)
+
+
+@_benchmark("fs-threads")
+def _bench_fs_threads(synth, args):
+    """
+    Read every texture from many threads at once, in small chunks, checking
+    each one's CRC.
+
+    """
+    num_threads = 16
+    reads_per_thread = 4
+
+    def read_all(fs, tex_names, thread_idx):
+        for tex_name in tex_names[thread_idx:] + tex_names[:thread_idx]:
+            path = fs.find(tex_name)
+            crc = 0
+            with fs.open(path) as f:
+                for chunk in iter(lambda: f.read(4096), b""):
+                    crc = zlib.crc32(chunk, crc)
+            if crc != fs.info(path).crc:
+                raise Exception("CRC mismatch reading {}".format(path))
+
+    fs = synth.fs()
+    tex_names = synth.tex_names
+    # Keep the cache small, so that both cached and uncached reads happen.
+    fs.cache_bytes = 256 * 1024
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+        futures = [executor.submit(read_all, fs, tex_names, i)
+                       for i in range(num_threads * reads_per_thread)]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    return _Result(elapsed=elapsed,
+                   count=len(tex_names) * len(futures),
+                   unit="files",
+                   note="{} threads, CRCs ok".format(num_threads))
+
+
+def _parse_args(in_args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", "-s", type=int, nargs="+",
+                        default=[1, 4, 16],
+                        help="Scales to run each benchmark at (default: 1 4 "
+                             "16)")
+    parser.add_argument("--repeat", "-r", type=int, default=3,
+                        help="Number of times to run each benchmark, "
+                             "keeping the fastest (default: 3)")
+    parser.add_argument("--color-reduce", type=int, default=8,
+                        help="Reduction factor for the colors-reduced "
+                             "benchmark")
+    parser.add_argument("--color-tolerance", type=float, default=0.01,
+                        help="Maximum error in any color component, from 0 "
+                             "to 1, allowed by the colors-reduced benchmark "
+                             "(default: 0.01)")
+    parser.add_argument("--baseline", default=_DEFAULT_BASELINE_PATH,
+                        help="Baseline file (default: {})".format(
+                            _DEFAULT_BASELINE_PATH))
+    parser.add_argument("--save-baseline", action='store_true',
+                        help="Save the results as the baseline, rather than "
+                             "comparing them with it")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Fail if a throughput is more than this "
+                             "fraction below the baseline (default: 0.25)")
+    parser.add_argument("benchmarks", nargs="*",
+                        help="Benchmarks to run (default: all). One of: "
+                             "{}".format(", ".join(_BENCHMARKS.keys())))
+
+    args = parser.parse_args(in_args)
+    for name in args.benchmarks:
+        if name not in _BENCHMARKS:
+            parser.error("Unknown benchmark {}".format(name))
+
+    return args
+
+
+def main(argv):
+    args = _parse_args(argv)
+
+    baseline = {}
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    throughputs = collections.OrderedDict()
+    regressions = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in args.scales:
+            synth = _Synth(scale, tmp_dir)
+            for name in args.benchmarks or _BENCHMARKS.keys():
+                fixed_size = name in _FIXED_SIZE_BENCHMARKS
+                if fixed_size and scale != args.scales[0]:
+                    continue
+                result = min((_BENCHMARKS[name](synth, args)
+                                  for _ in range(args.repeat)),
+                             key=lambda result: result.elapsed)
+
+                if fixed_size:
+                    key = name
+                else:
+                    key = "{}@{}".format(name, scale)
+                throughput = result.count / result.elapsed
+                throughputs[key] = throughput
+
+                status = ""
+                if key in baseline:
+                    change = throughput / baseline[key] - 1.
+                    status = "{:+6.1%}".format(change)
+                    if change < -args.tolerance:
+                        status += " REGRESSED"
+                        regressions.append(key)
+
+                print("{:24} {:8.3f} s {:12.0f} {}/s  {}  {}".format(
+                    key, result.elapsed, throughput, result.unit,
+                    status, result.note).rstrip())
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(throughputs, f, indent=4)
+            f.write("\n")
+        print("Saved baseline to {}".format(args.baseline))
+    elif regressions:
+        print("{} regressions against {}: {}".format(
+            len(regressions), args.baseline, ", ".join(regressions)))
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -2,62 +2,180 @@
 
 __all__ = (
     'main',
+    'map_names',
     'BspScene',
+    'calculate_texture_colors',
 )
 
 from pprint import pprint
 import argparse
+import array
 import collections
+import concurrent.futures
+import contextlib
+import functools
+import glob
+import io
+import math
+import os
 import pprint
+import re
 import sys
+import time
+import traceback
 
+import emitter
 import loadcolors
+import meshfile.obj
+import meshfile.ply
 import povray.sdl
 import q3.bsp
 import q3.fs
+import q3.instrument
 import yafaray.xml
 
 
+# File name extension of each output format.
+_EXTENSIONS = {
+    "povray": ".pov",
+    "yafaray": ".xml",
+    "ply": ".ply",
+    "obj": ".obj",
+}
+
+# Horizontal fields of view, in degrees, of the cameras written for each
+# output format. POV-Ray's default camera has a `right` vector of length 1.33
+# and a `direction` of length 1, and the Yafaray camera has a focal length of
+# 0.5 image widths.
+_DEFAULT_FOV = {
+    "povray": math.degrees(2. * math.atan(1.33 / 2.)),
+    "yafaray": 90.,
+}
+
+
+def _positive_float(s):
+    """Argument type for floats greater than zero."""
+    try:
+        value = float(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid number: {!r}".format(s))
+    if not value > 0:
+        raise argparse.ArgumentTypeError(
+            "must be greater than 0, not {}".format(s))
+    return value
+
+
+def _positive_int(s):
+    """Argument type for integers greater than zero."""
+    try:
+        value = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid integer: {!r}".format(s))
+    if value < 1:
+        raise argparse.ArgumentTypeError(
+            "must be greater than 0, not {}".format(s))
+    return value
+
+
 def warn(s):
     sys.stderr.write("Warning: {}\n".format(s))
 
 
+def info(s):
+    sys.stderr.write("{}\n".format(s))
+
+
 class _BspCamera():
     VIEW_CLASS = 'info_player_intermission'
 
-    def _get_entity(self, field, val):
-        ents = [ent for ent in self._bsp.entities
-                if field in ent and ent[field] == val]
-        assert len(ents) >= 1
-        return ents[0]
-
-    def __init__(self, bsp):
+    def __init__(self, bsp, comments=False):
         self._bsp = bsp
 
         # Calculate the location/direction.
-        view_ent = self._get_entity('classname', self.VIEW_CLASS)
-        target_ent = self._get_entity('targetname', view_ent["target"])
+        view_ents = bsp.entities_by_classname(self.VIEW_CLASS)
+        assert len(view_ents) >= 1
+        view_ent = view_ents[0]
+        target_ents = bsp.entities_by_targetname(view_ent["target"])
+        assert len(target_ents) >= 1
+        target_ent = target_ents[0]
 
         self.location = view_ent["origin"]
         self.look_at = target_ent["origin"]
 
-        # Print a comment making it clear which entities were used for the
-        # camera.
-        self.comment = "view_ent:\n"
-        self.comment += pprint.pformat(view_ent, 4)
-        self.comment += "\n\n"
-        self.comment += "target_ent:\n"
-        self.comment += pprint.pformat(target_ent, 4)
-        self.comment += "\n"
+        if comments:
+            # Print a comment making it clear which entities were used for the
+            # camera.
+            self.comment = "view_ent:\n"
+            self.comment += pprint.pformat(view_ent, 4)
+            self.comment += "\n\n"
+            self.comment += "target_ent:\n"
+            self.comment += pprint.pformat(target_ent, 4)
+            self.comment += "\n"
+
+    def frustum_planes(self, fov, aspect):
+        """
+        Return the planes bounding the camera's view, as `(normal, dist)`
+        pairs whose normals point into the view.
+
+        `fov` is the horizontal field of view in degrees, and `aspect` is the
+        width of the image divided by its height. The camera is assumed to be
+        upright, in the sense that the image's vertical axis is in the plane of
+        the Y axis and the view direction. There is no far plane.
+
+        """
+        forward = _normalize(_sub(self.look_at, self.location))
+        up = (0., 1.,  0.)
+        if abs(_dot(forward, up)) > 0.999:
+            # Looking straight up or down, so any horizontal axis will do.
+            up = (0., 0., 1.)
+        right = _normalize(_cross(up, forward))
+        up = _cross(forward, right)
+
+        tan_h = math.tan(math.radians(fov) / 2.)
+        tan_v = tan_h / aspect
+        normals = [
+            forward,
+            _add(_scale(forward, tan_h), right),
+            _sub(_scale(forward, tan_h), right),
+            _add(_scale(forward, tan_v), up),
+            _sub(_scale(forward, tan_v), up),
+        ]
+        return [(n, _dot(n, self.location)) for n in normals]
+
+
+def _add(a, b):
+    return tuple(x + y for x, y in zip(a, b))
+
+
+def _sub(a, b):
+    return tuple(x - y for x, y in zip(a, b))
+
+
+def _scale(a, k):
+    return tuple(x * k for x in a)
+
+
+def _dot(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+
+def _cross(a, b):
+    return (a[1] * b[2] - a[2] * b[1],
+            a[2] * b[0] - a[0] * b[2],
+            a[0] * b[1] - a[1] * b[0])
+
+
+def _normalize(a):
+    return _scale(a, 1. / math.sqrt(_dot(a, a)))
+
 
 _BspMaterial = collections.namedtuple('_BspMaterial',
         ['name', 'color'])
 
 class _BspTri():
-    def __init__(self, *verts, material, comment=""):
+    def __init__(self, *verts, material):
         assert len(verts) == 3
         self._verts = verts
-        self.comment = comment
         self.material = material
 
     def __iter__(self):
@@ -66,6 +184,31 @@ class _BspTri():
     def __len__(self):
         return len(self._verts)
 
+class _CommentedBspTri(_BspTri):
+    """
+    A triangle with a comment describing the face it came from.
+
+    The comment is only formatted when it is read.
+
+    """
+    def __init__(self, *verts, material, face, face_idx, vert_idx):
+        super().__init__(*verts, material=material)
+        self._face = face
+        self._face_idx = face_idx
+        self._vert_idx = vert_idx
+
+    @property
+    def comment(self):
+        comment = "Face = {}\n".format(self._face)
+        comment += "Face idx {} Tri idx {}\n".format(
+                       self._face_idx, self._vert_idx)
+        return comment
+
+_BspMesh = collections.namedtuple('_BspMesh',
+        ['positions', 'indices', 'material_indices', 'materials'])
+
+_BspRegion = collections.namedtuple('_BspRegion', ['mesh', 'bounds'])
+
 _BspLight = collections.namedtuple('_BspLight',
         ['location', 'color', 'intensity'])
 
@@ -83,29 +226,105 @@ class BspScene():
         Generate triangles by using a polygon fan approach on each face.
 
         """
-        for face_idx, face in enumerate(self._bsp.faces):
+        for face_idx, face in self._faces():
             if len(face.verts) < 3:
                 warn("{} (idx = {}) has < 3 "
                     "verts".format(face, face_idx))
                 continue
 
             first_vert = face.verts[0]
+            material = self.materials[face.texture.name]
             for vert_idx in range(2, len(face.verts)):
-                comment = "Face = {}\n".format(face)
-                comment += "Face idx {} Tri idx {}\n".format(
-                               face_idx, vert_idx)
-                yield _BspTri(
-                       first_vert,
-                       face.verts[vert_idx - 1],
-                       face.verts[vert_idx],
-                       material=self.materials[face.texture.name],
-                       comment=comment)
+                verts = (first_vert,
+                         face.verts[vert_idx - 1],
+                         face.verts[vert_idx])
+                if self._comments:
+                    yield _CommentedBspTri(*verts,
+                                           material=material,
+                                           face=face,
+                                           face_idx=face_idx,
+                                           vert_idx=vert_idx)
+                else:
+                    yield _BspTri(*verts, material=material)
+
+    def _faces(self):
+        """
+        Generate the triangular `q3.bsp.Face` objects of the faces in the
+        scene, along with the index of the BSP face each came from.
+
+        """
+        face_indices = self._face_indices
+        if face_indices is None:
+            face_indices = range(len(self._bsp.face_arrays.type))
+        for face_idx in face_indices:
+            for face in self._bsp.face_tris(face_idx):
+                yield face_idx, face
+
+    @functools.cached_property
+    def _bsp_mesh(self):
+        if self._face_indices is None:
+            return self._bsp.mesh
+        return self._bsp.build_mesh(self._face_indices)
 
     @property
-    def lights(self):
-        for light_ent in (ent for ent in self._bsp.entities
-                        if ent['classname'] == 'light'):
+    def mesh(self):
+        """
+        The scene's triangles as an indexed mesh.
+
+        Vertices are shared between triangles. Unless the scene is culled,
+        they keep their indices from the BSP file.
 
+        """
+        bsp_mesh = self._bsp_mesh
+        return _BspMesh(
+                positions=bsp_mesh.positions,
+                indices=bsp_mesh.indices,
+                material_indices=bsp_mesh.tri_textures,
+                materials=[self.materials[tex.name]
+                               for tex in self._bsp.textures])
+
+    def regions(self, max_faces):
+        """
+        Split the scene's geometry into spatially compact regions, each made
+        of at most `max_faces` BSP faces. See `q3.bsp.Bsp.partition_faces`.
+
+        Returns:
+            A list of regions, each with a `mesh`, which is like the scene's
+            `mesh` but has only the materials that its triangles use, and
+            `bounds`, a pair of the minimum and maximum corners of the box
+            enclosing the mesh. Regions without any triangles are left out.
+
+        """
+        regions = []
+        for face_indices in self._bsp.partition_faces(max_faces,
+                                                      self._face_indices):
+            bsp_mesh = self._bsp.build_mesh(face_indices)
+            if not bsp_mesh.tri_textures:
+                continue
+
+            tex_indices = sorted(set(bsp_mesh.tri_textures))
+            tex_to_material_idx = {tex_idx: material_idx
+                                       for material_idx, tex_idx
+                                       in enumerate(tex_indices)}
+            mesh = _BspMesh(
+                positions=bsp_mesh.positions,
+                indices=bsp_mesh.indices,
+                material_indices=array.array(
+                    'i', map(tex_to_material_idx.__getitem__,
+                             bsp_mesh.tri_textures)),
+                materials=[self.materials[self._bsp.textures[tex_idx].name]
+                               for tex_idx in tex_indices])
+
+            positions = bsp_mesh.positions
+            bounds = tuple(tuple(fn(positions[axis::3]) for axis in range(3))
+                               for fn in (min, max))
+            regions.append(_BspRegion(mesh=mesh, bounds=bounds))
+
+        return regions
+
+    @property
+    def lights(self):
+        for light_ent in self._bsp.entities_by_classname('light'):
             if not "_color" in light_ent:
                 color = (1.0, 1.0, 1.0)
             else:
@@ -117,53 +336,569 @@ class BspScene():
 
     @property
     def camera(self):
-        return _BspCamera(self._bsp)
+        return _BspCamera(self._bsp, comments=self._comments)
+
+    def _make_materials(self, jobs, colors):
+        tex_names = list(collections.OrderedDict.fromkeys(
+                            tex.name for tex in self._bsp.textures))
+        if colors is not None:
+            colors = [colors[tex_name] for tex_name in tex_names]
+        else:
+            colors = loadcolors.calculate_colors(self._fs, tex_names,
+                                                 self._color_cache, jobs,
+                                                 self._color_reduce)
+
+        materials = {}
+        for tex_name, color in zip(tex_names, colors):
+            if isinstance(color, Exception):
+                color = (0., 1., 0.)
+            materials[tex_name] = _BspMaterial(name=tex_name, color=color)
+
+        return materials
+
+    @q3.instrument.staged("cull")
+    def _cull(self, cull, fov, aspect, far):
+        if not cull and far is None:
+            return
+        bsp = self._bsp
+
+        # The camera is only looked up once culling is known to be needed, so
+        # that maps without one can still be converted unculled.
+        stages = []
+        for mode in cull:
+            if mode == "pvs":
+                def stage(face_indices):
+                    visible = set(bsp.visible_faces(self.camera.location))
+                    return [f for f in face_indices if f in visible]
+            elif mode == "frustum":
+                def stage(face_indices):
+                    return bsp.faces_inside(
+                        self.camera.frustum_planes(fov, aspect), face_indices)
+            else:
+                raise ValueError("Unknown cull mode {!r}".format(mode))
+            stages.append((mode, stage))
+        if far is not None:
+            stages.append(("distance", lambda face_indices:
+                              bsp.faces_near(self.camera.location, far,
+                                             face_indices)))
+
+        face_indices = range(len(bsp.face_arrays.type))
+        for mode, stage in stages:
+            kept = stage(face_indices)
+            kept_set = set(kept)
+            self.culled_tris[mode] = sum(bsp.face_tri_count(f)
+                                             for f in face_indices
+                                             if f not in kept_set)
+            face_indices = kept
+
+        self._face_indices = face_indices
+
+    def __init__(self, bsp, fs, comments=False, color_cache=None, jobs=1,
+                 color_reduce=1, cull=(), fov=_DEFAULT_FOV["povray"],
+                 aspect=4 / 3, far=None, colors=None):
+        """
+        Create a scene from a BSP.
+
+        If `comments` is true, triangles and the camera have a `comment`
+        attribute describing the BSP data they were made from. This is for
+        debugging, and slows down output considerably.
+
+        `color_cache` is an optional `loadcolors.ColorCache` used when
+        calculating material colors, and `jobs` is the number of processes to
+        calculate them with. `color_reduce` is passed to
+        `loadcolors.calculate_color` as `reduce`. Alternatively, `colors`
+        may be a mapping of every texture name in the BSP onto a color, or
+        onto an exception if it could not be calculated, as returned by
+        `calculate_texture_colors`. No colors are calculated in this case.
+
+        `cull` is an iterable of ways of removing faces that cannot be seen
+        from the camera, applied in order:
+
+            .. pvs:: Keep only faces in BSP leaves whose clusters are
+                potentially visible from the camera's cluster.
+            .. frustum:: Keep only faces whose bounding boxes are at least
+                partly within the camera's view, as given by `fov` (the
+                horizontal field of view in degrees) and `aspect` (the image's
+                width divided by its height).
+
+        If `far` is not `None`, faces whose bounding boxes are entirely further
+        than `far` from the camera are also removed. The number of triangles
+        removed by each kind of culling is recorded in the `culled_tris`
+        dict, keyed by "pvs", "frustum" or "distance".
 
-    def _make_material(self, tex):
+        """
+        self._bsp = bsp
+        self._fs = fs
+        self._comments = comments
+        self._color_cache = color_cache
+        self._color_reduce = color_reduce
+
+        # _face_indices holds the indices of the BSP faces in the scene, or
+        # `None` if all faces are included.
+        self._face_indices = None
+        self.culled_tris = collections.OrderedDict()
+        self._cull(cull, fov, aspect, far)
+
+        if q3.instrument.active() is not None:
+            for face_type, n in bsp.face_type_counts(
+                                            self._face_indices).items():
+                q3.instrument.count("faces-" + face_type, n)
+            face_indices = self._face_indices
+            if face_indices is None:
+                face_indices = range(len(bsp.face_arrays.type))
+            q3.instrument.count("tris", sum(map(bsp.face_tri_count,
+                                                face_indices)))
+
+        self.materials = self._make_materials(jobs, colors)
+
+
+def map_names(fs):
+    """Return a sorted list of the names of the maps in a filesystem."""
+    return [path[len("maps/"):-len(".bsp")] for path in fs.paths
+                if path.startswith("maps/") and path.endswith(".bsp") and
+                    "/" not in path[len("maps/"):]]
+
+
+def calculate_texture_colors(fs, map_names, color_cache=None, jobs=1,
+                             color_reduce=1):
+    """
+    Calculate the colors of every texture used by any of a set of maps.
+
+    The arguments are as for `BspScene`. Each texture's color is only
+    calculated once, however many maps use it. Maps that cannot be read are
+    skipped, with a warning.
+
+    Returns:
+        A dict mapping each texture name onto an RGB triple, or onto the
+        exception raised when calculating its color.
+
+    """
+    tex_names = collections.OrderedDict()
+    for map_name in map_names:
         try:
-            color = loadcolors.calculate_color(self._fs, tex.name)
+            bsp = q3.bsp.Bsp(fs.map("maps/{}.bsp".format(map_name)))
+            tex_names.update((tex.name, None) for tex in bsp.textures)
         except Exception as e:
-            color = (0., 1., 0.)
+            warn("Could not read textures of {}: {}".format(map_name, e))
+    tex_names = list(tex_names)
 
-        return _BspMaterial(name=tex.name, color=color)
+    colors = loadcolors.calculate_colors(fs, tex_names, color_cache, jobs,
+                                         color_reduce)
+    return dict(zip(tex_names, colors))
 
-    def __init__(self, bsp, fs):
-        self._bsp = bsp
-        self._fs = fs
 
-        self.materials = {
-            tex.name: self._make_material(tex)
-                for tex in self._bsp.textures
-        }
+def _mtl_path(obj_path, args):
+    """
+    Return the path of the MTL file written alongside an OBJ file.
+
+    """
+    if args.compress is not None:
+        suffix = emitter.COMPRESSIONS[args.compress]
+        if obj_path.endswith(suffix):
+            obj_path = obj_path[:-len(suffix)]
+    return os.path.splitext(obj_path)[0] + ".mtl"
+
+
+def _output_paths(out_path, args):
+    """Return the paths of all the files written for `out_path`."""
+    if args.format == "obj":
+        return [out_path, _mtl_path(out_path, args)]
+    return [out_path]
+
+
+_PovRegion = collections.namedtuple('_PovRegion',
+        ['name', 'include', 'bounds', 'mesh'])
+
+
+def _write_region_file(path, region):
+    """
+    Write a region's include file, unless it already exists with the same
+    contents. Returns the number of characters written, which is 0 if the
+    file was left alone.
+
+    Leaving unchanged files alone keeps their modification times, so that
+    anything derived from them need not be regenerated.
+
+    """
+    sdl_file = io.StringIO()
+    povray.sdl.write_region(sdl_file, region)
+    contents = sdl_file.getvalue()
+    with contextlib.suppress(FileNotFoundError):
+        with open(path) as f:
+            if f.read() == contents:
+                return 0
+    with open(path, "w") as f:
+        f.write(contents)
+    return len(contents)
+
+
+@q3.instrument.staged("write-regions")
+def _write_regions(scene, out_path, args, jobs):
+    """
+    Split a scene into regions, writing an include file for each one next to
+    `out_path`, and return the regions.
+
+    Include files are written in `jobs` processes. Include files left over
+    from a previous conversion with more regions are removed.
+
+    """
+    out_dir = os.path.dirname(out_path)
+    base_name = os.path.splitext(os.path.basename(out_path))[0]
+    regions = [_PovRegion(name="Region_{}".format(idx),
+                          include="{}_r{}.inc".format(base_name, idx),
+                          bounds=region.bounds,
+                          mesh=region.mesh)
+                   for idx, region
+                   in enumerate(scene.regions(args.region_faces))]
+    paths = [os.path.join(out_dir, region.include) for region in regions]
+
+    if jobs > 1 and len(regions) > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs,
+                initializer=q3.instrument.reset) as executor:
+            chars = list(executor.map(_write_region_file, paths, regions))
+    else:
+        chars = list(map(_write_region_file, paths, regions))
+    num_written = sum(1 for n in chars if n)
+    q3.instrument.count("regions-written", num_written)
+    q3.instrument.count("regions-unchanged", len(chars) - num_written)
+    q3.instrument.count("chars-written", sum(chars))
+
+    # Only match `<base_name>_r<number>.inc`, and not the include files of
+    # another map whose name starts with `<base_name>_r`.
+    include_re = re.compile(re.escape(base_name) + r"_r\d+\.inc")
+    stale_paths = {path for path in glob.glob(os.path.join(
+                       glob.escape(out_dir), glob.escape(base_name) + "_r*"))
+                       if include_re.fullmatch(os.path.basename(path))}
+    for path in stale_paths - set(paths):
+        os.remove(path)
+
+    return [region._replace(mesh=None) for region in regions]
+
+
+def _write_scene(out_file, scene, args, mtl_file=None, mtl_name=None,
+                 regions=None):
+    if args.format == "yafaray":
+        yafaray.xml.write(out_file, scene)
+    elif args.format == "ply":
+        meshfile.ply.write(out_file, scene)
+    elif args.format == "obj":
+        meshfile.obj.write(out_file, scene, mtl_file=mtl_file,
+                           mtl_name=mtl_name)
+    else:
+        # Triangle comments are only written for individual triangles, so
+        # `--comments` implies `--mesh2 off` (`_parse_args` rejects `on`).
+        mesh2 = {"auto": None, "on": True, "off": False}[args.mesh2]
+        if args.comments:
+            mesh2 = False
+        povray.sdl.write(out_file, scene, mesh2=mesh2, regions=regions)
+
+
+def _convert_map(fs, map_name, out_path, args, color_cache=None,
+                 colors=None, region_jobs=1):
+    """
+    Write the scene for a map to `out_path`, or to stdout if it is `None` or
+    "-", returning the `BspScene`'s `culled_tris`.
+
+    OBJ output is accompanied by an MTL file of materials, unless it is
+    written to stdout. If `args.region_faces` is set, the geometry is
+    written to an include file per region instead, using `region_jobs`
+    processes.
+
+    """
+    if out_path == "-":
+        out_path = None
+
+    fov = args.fov
+    if fov is None:
+        fov = _DEFAULT_FOV.get(args.format, _DEFAULT_FOV["povray"])
+    bsp = q3.bsp.Bsp(fs.map("maps/{}.bsp".format(map_name)),
+                     patch_tolerance=args.patch_tolerance)
+    scene = BspScene(bsp, fs,
+                     comments=args.comments, color_cache=color_cache,
+                     jobs=args.jobs, color_reduce=args.color_reduce,
+                     cull=args.cull, fov=fov, aspect=args.aspect,
+                     far=args.far, colors=colors)
+
+    regions = None
+    if args.region_faces is not None:
+        regions = _write_regions(scene, out_path, args, region_jobs)
+
+    with contextlib.ExitStack() as stack:
+        out_file = stack.enter_context(emitter.open_output(
+            out_path, args.compress, binary=(args.format == "ply")))
+        mtl_file = mtl_name = None
+        if args.format == "obj" and out_path is not None:
+            mtl_path = _mtl_path(out_path, args)
+            mtl_file = stack.enter_context(open(mtl_path, "w"))
+            mtl_name = os.path.basename(mtl_path)
+
+        if q3.instrument.active() is not None:
+            out_file = q3.instrument.CountingWriter(
+                out_file,
+                "bytes-written" if args.format == "ply" else "chars-written")
+            if mtl_file is not None:
+                mtl_file = q3.instrument.CountingWriter(mtl_file,
+                                                        "chars-written")
+        with q3.instrument.stage("write"):
+            _write_scene(out_file, scene, args, mtl_file=mtl_file,
+                         mtl_name=mtl_name, regions=regions)
+
+    return scene.culled_tris
+
+
+# Filesystem and texture colors used by batch worker processes.
+_batch_fs = None
+_batch_colors = None
+
+
+def _init_batch_worker(pk3_paths, index_path, colors):
+    global _batch_fs, _batch_colors
+    q3.instrument.reset()
+    _batch_fs = q3.fs.FileSystem(pk3_paths, index_path=index_path)
+    _batch_colors = colors
+
+
+_BatchResult = collections.namedtuple('_BatchResult',
+        ['map_name', 'elapsed', 'culled_tris', 'error', 'profile'])
+
+
+def _batch_convert_map(map_name, out_path, args):
+    """
+    Convert a map in a batch worker process.
+
+    Exceptions are caught and returned in the result, so that one failing map
+    does not stop the rest of the batch, and the map's output file is
+    removed.
+
+    """
+    start = time.perf_counter()
+    culled_tris = None
+    error = None
+    with contextlib.ExitStack() as stack:
+        profiler = None
+        if args.profile:
+            profiler = stack.enter_context(q3.instrument.profiling())
+        try:
+            culled_tris = _convert_map(_batch_fs, map_name, out_path, args,
+                                       colors=_batch_colors)
+        except Exception:
+            error = traceback.format_exc()
+            # Don't leave partially written output behind.
+            for path in _output_paths(out_path, args):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+    return _BatchResult(map_name=map_name,
+                        elapsed=time.perf_counter() - start,
+                        culled_tris=culled_tris,
+                        error=error,
+                        profile=(profiler.as_dict() if profiler is not None
+                                     else None))
+
+
+def _run_batch(fs, map_names, args, color_cache):
+    """
+    Convert several maps in parallel, writing each to its own file in
+    `args.output_dir`.
+
+    Texture colors are calculated once, up front, for all of the maps. Worker
+    processes share the filesystem's pk3 index.
+
+    Returns:
+        The number of maps that failed to convert.
+
+    """
+    start = time.perf_counter()
+    colors = calculate_texture_colors(fs, map_names, color_cache, args.jobs,
+                                      args.color_reduce)
+    info("Calculated {} texture colors in {:.2f} s".format(
+            len(colors), time.perf_counter() - start))
+
+    ext = _EXTENSIONS[args.format]
+    if args.compress is not None:
+        ext += emitter.COMPRESSIONS[args.compress]
+    os.makedirs(args.output_dir, exist_ok=True)
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.jobs,
+            initializer=_init_batch_worker,
+            initargs=(fs.pk3_paths, fs.index_path, colors)) as executor:
+        futures = [executor.submit(_batch_convert_map, map_name,
+                                   os.path.join(args.output_dir,
+                                                map_name + ext),
+                                   args)
+                       for map_name in map_names]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            if result.profile is not None:
+                q3.instrument.active().merge(result.profile)
+            if result.error is not None:
+                failures += 1
+                warn("{} failed after {:.2f} s:\n{}".format(
+                        result.map_name, result.elapsed, result.error))
+                continue
+
+            culled = "".join(", culled {} triangles ({})".format(count, mode)
+                                 for mode, count
+                                 in result.culled_tris.items())
+            info("{}: {:.2f} s{}".format(result.map_name, result.elapsed,
+                                         culled))
+
+    info("Converted {} of {} maps in {:.2f} s".format(
+            len(map_names) - failures, len(map_names),
+            time.perf_counter() - start))
+
+    return failures
 
 
 def _parse_args(in_args):
     parser = argparse.ArgumentParser()
     parser.add_argument("--baseq3", "-b",
             help="Directory containing pk3 files", required=True)
-    parser.add_argument("--map", "-m", help="The map to view", required=True)
-    parser.add_argument("--output-file", "-o", help="Output .pov/.xml file")
-    parser.add_argument("--yafaray", "-y",
-                        help="Output a Yafaray XML file",
+    maps_group = parser.add_mutually_exclusive_group(required=True)
+    maps_group.add_argument("--map", "-m", nargs="+", dest="maps",
+                            help="The map(s) to view")
+    maps_group.add_argument("--all-maps",
+                            help="Convert every map in the pk3 files",
+                            action='store_true')
+    parser.add_argument("--output-file", "-o",
+                        help="Output .pov/.xml/.ply/.obj file, when "
+                             "converting a single map")
+    parser.add_argument("--output-dir", "-d", default=".",
+                        help="Directory to write an output file for each "
+                             "map into, when converting several maps "
+                             "(default: the current directory)")
+    format_group = parser.add_mutually_exclusive_group()
+    format_group.add_argument("--yafaray", "-y",
+                              help="Output a Yafaray XML file",
+                              action='store_const', dest="format",
+                              const="yafaray")
+    format_group.add_argument("--ply",
+                              help="Output the geometry and materials as a "
+                                   "binary PLY file",
+                              action='store_const', dest="format",
+                              const="ply")
+    format_group.add_argument("--obj",
+                              help="Output the geometry as an OBJ file, "
+                                   "with its materials in an MTL file of the "
+                                   "same name",
+                              action='store_const', dest="format",
+                              const="obj")
+    parser.add_argument("--comments",
+                        help="Write debugging comments describing the BSP "
+                             "data each element came from. POV-Ray "
+                             "triangles are then always written "
+                             "individually, as if by --mesh2 off.",
                         action='store_true')
-
-    return parser.parse_args(in_args)
+    parser.add_argument("--mesh2",
+                        help="Write POV-Ray geometry as a single mesh2 "
+                             "object. By default this is done for large "
+                             "maps.",
+                        choices=("auto", "on", "off"),
+                        default="auto")
+    parser.add_argument("--compress",
+                        help="Compress the output as it is written. zstd "
+                             "requires the zstandard package.",
+                        choices=sorted(emitter.COMPRESSIONS))
+    parser.add_argument("--region-faces", type=_positive_int, metavar="N",
+                        help="Split the geometry into spatially compact "
+                             "regions of at most N BSP faces. Each region is "
+                             "written to its own include file next to the "
+                             "output file, which includes them. Include "
+                             "files that have not changed are not rewritten. "
+                             "POV-Ray only.")
+    parser.add_argument("--patch-tolerance", type=_positive_float,
+                        default=2.0,
+                        help="Maximum distance in map units between "
+                             "tessellated curves and the true surface "
+                             "(default: 2.0)")
+    parser.add_argument("--cull",
+                        help="Omit faces that cannot be seen from the "
+                             "camera. pvs uses the map's visibility "
+                             "information, and frustum removes faces outside "
+                             "of the camera's field of view. May be given "
+                             "more than once.",
+                        choices=("pvs", "frustum"),
+                        action='append',
+                        default=[])
+    parser.add_argument("--fov", type=float,
+                        help="Horizontal field of view in degrees, used by "
+                             "--cull frustum (default: that of the output "
+                             "format's camera)")
+    parser.add_argument("--aspect", type=float, default=4 / 3,
+                        help="Image width divided by height, used by --cull "
+                             "frustum (default: 4/3)")
+    parser.add_argument("--far", type=float,
+                        help="Omit faces further than this many map units "
+                             "from the camera")
+    parser.add_argument("--jobs", "-j", type=_positive_int,
+                        default=os.cpu_count() or 1,
+                        help="Number of processes used to calculate texture "
+                             "colors and to convert maps (default: number "
+                             "of CPUs)")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="Write the time and peak memory taken by each "
+                             "stage, and counts of faces, triangles, "
+                             "textures and characters written (bytes for "
+                             "PLY), to FILE as JSON. - writes to stderr")
+    loadcolors.add_color_cache_args(parser)
+    loadcolors.add_pk3_index_args(parser)
+
+    parser.set_defaults(format="povray")
+
+    args = parser.parse_args(in_args)
+    if args.output_file and (args.all_maps or len(args.maps) > 1):
+        parser.error("--output-file can only be used with a single map")
+    if args.region_faces is not None:
+        if args.format != "povray":
+            parser.error("--region-faces can only be used with POV-Ray "
+                         "output")
+        if args.compress is not None:
+            parser.error("--region-faces cannot be used with --compress")
+        if (not args.all_maps and len(args.maps) == 1 and
+                args.output_file in (None, "-")):
+            parser.error("--region-faces requires --output-file when "
+                         "converting a single map")
+    if args.comments and (args.mesh2 == "on" or
+                          args.region_faces is not None):
+        parser.error("--comments cannot be used with --mesh2 on or "
+                     "--region-faces, whose geometry has no comments")
+    if args.compress == "zstd" and emitter.zstandard is None:
+        parser.error("--compress zstd requires the zstandard package")
+
+    return args
 
 
 def main(argv):
     args = _parse_args(argv)
-
-    sdl_file = open(args.output_file, "w") if args.output_file else sys.stdout
-
-    fs = q3.fs.FileSystem.from_dir(args.baseq3)
-
-    with fs.open("maps/{}.bsp".format(args.map)) as bsp_file:
-        bsp = q3.bsp.Bsp(bsp_file)
-        scene = BspScene(bsp, fs)
-
-        write_fn = yafaray.xml.write if args.yafaray else povray.sdl.write
-
-        write_fn(sdl_file, scene)
+    with q3.instrument.profiling_to_file(args.profile):
+        return _run(args)
+
+
+def _run(args):
+    fs = q3.fs.FileSystem.from_dir(
+        args.baseq3, index_path=loadcolors.pk3_index_path_from_args(args))
+    color_cache = loadcolors.color_cache_from_args(args)
+
+    # Close the cache even on failure, to keep the colors already calculated.
+    failures = 0
+    try:
+        if args.all_maps or len(args.maps) > 1:
+            failures = _run_batch(fs,
+                                  map_names(fs) if args.all_maps else args.maps,
+                                  args, color_cache)
+        else:
+            culled_tris = _convert_map(fs, args.maps[0], args.output_file,
+                                       args, color_cache=color_cache,
+                                       region_jobs=args.jobs)
+            for mode, count in culled_tris.items():
+                info("Culled {} triangles ({})".format(count, mode))
+    finally:
+        if color_cache is not None:
+            color_cache.close()
+
+    return 1 if failures else 0
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
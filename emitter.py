@@ -0,0 +1,251 @@
+"""
+Buffered output of indented text, shared by the scene writers.
+
+An `Emitter` collects lines in memory and writes them to the underlying file
+in large chunks, rather than making a `write` call per line. Indentation
+prefixes are built once per level. Rows of numbers, such as vertex
+coordinates, can be formatted many at a time with `rows`::
+
+    with Emitter(f) as out:
+        out.line("vertex_vectors")
+        with out.indented():
+            spec = float_spec(positions)
+            out.rows("<{0}, {0}, {0}>,".format(spec), positions, 3)
+
+Output files, optionally compressed, are opened with `open_output`.
+
+"""
+
+__all__ = (
+    'COMPRESSIONS',
+    'Emitter',
+    'float_spec',
+    'open_output',
+)
+
+
+import array
+import contextlib
+import gzip
+import io
+import sys
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Number of characters buffered before they are written to the file.
+_CHUNK_SIZE = 1 << 18
+
+# Maximum number of rows formatted by a single `%` operation in `rows`.
+_ROWS_PER_FORMAT = 512
+
+# File name extension of each supported compression method.
+COMPRESSIONS = {
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
+
+
+class Emitter():
+    """
+    Write indented lines of text to a file.
+
+    Output is buffered until `chunk_size` characters are waiting, or until
+    `flush` is called. Used as a context manager, the emitter is flushed at
+    the end of the block. The underlying file is not closed.
+
+    """
+
+    def __init__(self, f, indent_str="  ", chunk_size=_CHUNK_SIZE):
+        self._f = f
+        self._indent_str = indent_str
+        self._chunk_size = chunk_size
+        self._parts = []
+        self._size = 0
+
+        self._indent = 0
+        self._prefix = ""
+        self._row_templates = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def write(self, s):
+        """Write a string as is, without indentation."""
+        self._parts.append(s)
+        self._size += len(s)
+        if self._size >= self._chunk_size:
+            self.flush()
+
+    def line(self, line):
+        """Write a line at the current indentation."""
+        self.write(self._prefix + line + "\n")
+
+    def lines(self, lines):
+        """Write each of an iterable of lines at the current indentation."""
+        prefix = self._prefix
+        self.write("".join(prefix + line + "\n" for line in lines))
+
+    @contextlib.contextmanager
+    def indented(self):
+        """Context manager that indents lines written within it."""
+        self._set_indent(self._indent + 1)
+        try:
+            yield
+        finally:
+            self._set_indent(self._indent - 1)
+
+    def _set_indent(self, indent):
+        self._indent = indent
+        self._prefix = self._indent_str * indent
+        # Row templates include the prefix, so are only valid at one level.
+        self._row_templates = {}
+
+    def template(self, lines):
+        """
+        Return a format string for several lines, to be passed to `write`
+        once formatted.
+
+        `lines` is a sequence of `(depth, line)` pairs, where `depth` is the
+        number of levels below the current indentation to indent `line` by.
+        Literal braces in lines must be doubled, as with any format string.
+
+        """
+        return "".join(self._prefix + self._indent_str * depth + line + "\n"
+                           for depth, line in lines)
+
+    def rows(self, row_format, values, row_len, headers=()):
+        """
+        Write a line for each `row_len` values of a flat sequence.
+
+        `row_format` is a printf-style format string taking `row_len`
+        values. Many rows are formatted by each `%` operation, which is much
+        faster than formatting them one at a time.
+
+        `headers` is an iterable of `(row_idx, line)` pairs, in order of
+        `row_idx`, each giving a line to write before a row.
+
+        """
+        num_rows = len(values) // row_len
+        headers = iter(headers)
+        next_header = next(headers, None)
+        for start_row in range(0, num_rows, _ROWS_PER_FORMAT):
+            end_row = min(start_row + _ROWS_PER_FORMAT, num_rows)
+            template = self._row_template(row_format, end_row - start_row)
+            text = template % tuple(values[start_row * row_len:
+                                           end_row * row_len])
+            if next_header is None or next_header[0] >= end_row:
+                self.write(text)
+                continue
+
+            # Split the rows into lines, to insert the headers between them.
+            row_lines = text.splitlines(keepends=True)
+            pieces = []
+            prev_row = start_row
+            while next_header is not None and next_header[0] < end_row:
+                row_idx, line = next_header
+                pieces.extend(row_lines[prev_row - start_row:
+                                        row_idx - start_row])
+                pieces.append(self._prefix + line + "\n")
+                prev_row = row_idx
+                next_header = next(headers, None)
+            pieces.extend(row_lines[prev_row - start_row:])
+            self.write("".join(pieces))
+
+    def _row_template(self, row_format, num_rows):
+        key = (row_format, num_rows)
+        template = self._row_templates.get(key)
+        if template is None:
+            template = (self._prefix + row_format + "\n") * num_rows
+            self._row_templates[key] = template
+        return template
+
+    def flush(self):
+        """Write any buffered output to the file."""
+        if self._parts:
+            self._f.write("".join(self._parts))
+            self._parts = []
+            self._size = 0
+
+
+def float_spec(values):
+    """
+    Return a printf-style conversion specifier that writes each of a
+    sequence of floats exactly.
+
+    Single precision floats held in an `array.array` are written with 9
+    significant digits, which is enough to recover them exactly. This is much
+    faster than `repr`, which writes the many more digits needed to recover
+    the double precision floats they are converted to. Other floats are
+    written with `repr`.
+
+    """
+    if isinstance(values, array.array) and values.typecode == 'f':
+        return "%.9g"
+    return "%r"
+
+
+@contextlib.contextmanager
+def open_output(path=None, compression=None, binary=False):
+    """
+    Context manager that opens a file for writing, and yields it.
+
+    If `path` is `None` or "-" the output goes to standard output, which is
+    left open afterwards. `compression` may be one of the keys of
+    `COMPRESSIONS` to compress the output as it is written, in which case
+    standard output receives the compressed bytes. zstd compression requires
+    the `zstandard` package.
+
+    The file is a text file, unless `binary` is true.
+
+    """
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError("Unknown compression {!r}".format(compression))
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd compression requires the zstandard package")
+
+    to_stdout = path is None or path == "-"
+    if compression is None:
+        if to_stdout:
+            if binary:
+                sys.stdout.flush()
+                yield sys.stdout.buffer
+                sys.stdout.buffer.flush()
+            else:
+                yield sys.stdout
+        else:
+            with open(path, "wb" if binary else "w") as f:
+                yield f
+        return
+
+    with contextlib.ExitStack() as stack:
+        if to_stdout:
+            sys.stdout.flush()
+            raw_file = sys.stdout.buffer
+        else:
+            raw_file = stack.enter_context(open(path, "wb"))
+
+        if compression == "gzip":
+            compressed_file = gzip.GzipFile(fileobj=raw_file, mode="wb",
+                                            compresslevel=6)
+        else:
+            compressed_file = zstandard.ZstdCompressor().stream_writer(
+                raw_file, closefd=False)
+        stack.callback(compressed_file.close)
+        if binary:
+            yield compressed_file
+            return
+
+        # Closing the text wrapper would close the compressed file before it
+        # is flushed, so detach it instead.
+        text_file = io.TextIOWrapper(compressed_file, write_through=True)
+        stack.callback(text_file.detach)
+        stack.callback(text_file.flush)
+
+        yield text_file
@@ -12,29 +12,142 @@ Note this module requires pillow (or equivalent) to be installed.
 
 
 __all__ = (
+    'add_color_cache_args',
     'calculate_color',
+    'calculate_colors',
+    'color_cache_from_args',
+    'ColorCache',
     'main'
 )
 
 
 import argparse
+import concurrent.futures
+import itertools
 import os
+import sqlite3
 import sys
 
 from PIL import Image
+from PIL import ImageStat
 
 import q3.bsp
 import q3.fs
+import q3.instrument
+
+# Version of the cache database's schema. Databases with other versions are
+# emptied when opened.
+_CACHE_VERSION = 2
+
+
+def _default_cache_path():
+    return os.path.join(q3.fs.default_cache_dir(), "colors.sqlite")
+
+
+class ColorCache():
+    """
+    A persistent cache of texture colors, stored in an SQLite database.
+
+    Entries are keyed on the pk3 file, the member's path and its CRC and size
+    as given in the pk3's directory, so modified or replaced textures are not
+    matched. Colors calculated with different `reduce` factors are stored
+    separately. The number of entries is bounded; when the bound is exceeded the
+    least recently used entries are evicted.
+
+    Attributes:
+        hits: Number of lookups that found a color.
+        misses: Number of lookups that did not find a color.
+
+    """
+
+    def __init__(self, path=None, max_entries=100000):
+        """
+        Open (creating if necessary) a color cache.
+
+        Arguments:
+            path: Path to the database. Defaults to a file in the user's
+                cache directory.
+            max_entries: Maximum number of colors to retain.
+
+        """
+        if path is None:
+            path = _default_cache_path()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._db = sqlite3.connect(path)
+        if (self._db.execute("PRAGMA user_version").fetchone()[0] !=
+                _CACHE_VERSION):
+            self._db.execute("DROP TABLE IF EXISTS colors")
+            self._db.execute("PRAGMA user_version = {}".format(
+                _CACHE_VERSION))
+        self._db.execute("CREATE TABLE IF NOT EXISTS colors ("
+                         "pk3_path TEXT, path TEXT, crc INTEGER, "
+                         "size INTEGER, reduce INTEGER, "
+                         "r REAL, g REAL, b REAL, last_used INTEGER, "
+                         "PRIMARY KEY (pk3_path, path, crc, size, reduce))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS colors_last_used "
+                         "ON colors (last_used)")
+        self._max_entries = max_entries
+        self._clock = self._db.execute(
+            "SELECT COALESCE(MAX(last_used), 0) FROM colors").fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def get(self, file_info, reduce=1):
+        """
+        Look up the color for a `q3.fs.FileInfo`.
+
+        Returns:
+            An RGB triple, or `None` if there is no entry.
+
+        """
+        key = tuple(file_info) + (reduce,)
+        row = self._db.execute(
+            "SELECT r, g, b FROM colors WHERE pk3_path = ? AND path = ? AND "
+            "crc = ? AND size = ? AND reduce = ?", key).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._db.execute(
+            "UPDATE colors SET last_used = ? WHERE pk3_path = ? AND "
+            "path = ? AND crc = ? AND size = ? AND reduce = ?",
+            (self._tick(),) + key)
+        return row
+
+    def put(self, file_info, reduce, color):
+        """Store the color for a `q3.fs.FileInfo`."""
+        self._db.execute(
+            "INSERT OR REPLACE INTO colors VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            tuple(file_info) + (reduce,) + tuple(color) + (self._tick(),))
+        self._db.execute(
+            "DELETE FROM colors WHERE last_used <= ("
+            "SELECT last_used FROM colors ORDER BY last_used DESC "
+            "LIMIT 1 OFFSET ?)", (self._max_entries,))
+
+    def close(self):
+        """Write outstanding changes to disk, and close the database."""
+        self._db.commit()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-def _open_tex_file(fs, tex_name):
-    def match(path):
-        return path.lower() in (
-                tex_name.lower() + ".jpg", tex_name.lower() + ".tga")
 
-    match_iter = iter(path for path in fs.paths if match(path))
+def _open_tex_file(fs, tex_name):
     try:
-        tex_path = next(match_iter)
-    except StopIteration:
+        tex_path = fs.find(tex_name)
+    except KeyError:
         raise KeyError("Texture {} not found within FS".format(tex_name))
 
     return fs.open(tex_path)
@@ -50,35 +163,147 @@ def _save_image(fs, tex_name, image_dir):
     im = Image.open(tex_file)
     im.save(os.path.join(image_dir, _tex_name_to_image_name(tex_name)))
 
-def calculate_color(fs, tex_name):
+def calculate_color(fs, tex_name, cache=None, reduce=1):
     """
     Calculate the average color of a texture.
 
     Arguments:
         fs: Filesystem to find the texture.
         tex_name: Name of the texture to find (without extension).
+        cache: (Optional.) A `ColorCache` to look up the color in, and to
+            store it in if it is not found.
+        reduce: Factor by which to reduce the image's width and height before
+            averaging, trading accuracy for speed. JPEGs are decoded directly
+            at the reduced size. Other formats, such as TGA, have no reduced
+            decoding, so are decoded in full first and gain little. 1 gives
+            the exact average.
 
     Returns:
         An RGB triple representing the average color.
 
     """
+    color, = calculate_colors(fs, [tex_name], cache, reduce=reduce)
+    if isinstance(color, Exception):
+        raise color
+    return color
+
+
+@q3.instrument.staged("colors")
+def calculate_colors(fs, tex_names, cache=None, jobs=1, reduce=1):
+    """
+    Calculate the average colors of several textures, optionally in parallel.
+
+    Arguments:
+        fs: Filesystem to find the textures.
+        tex_names: Sequence of names of textures (without extension).
+        cache: (Optional.) A `ColorCache` to look up colors in, and to store
+            them in if they are not found.
+        jobs: Number of worker processes to calculate colors with. Each
+            worker opens the filesystem's pk3 files itself.
+        reduce: As for `calculate_color`.
+
+    Returns:
+        A list with an entry for each texture in `tex_names`: either an RGB
+        triple, or the exception raised when calculating the color.
+
+    """
+    if jobs < 1:
+        raise ValueError("jobs must be at least 1, not {!r}".format(jobs))
+    results = [None] * len(tex_names)
+
+    # Look up colors in the cache, and make a list of those that need
+    # calculating.
+    pending = []
+    file_infos = {}
+    for idx, tex_name in enumerate(tex_names):
+        if cache is not None:
+            try:
+                file_infos[idx] = fs.info(fs.find(tex_name))
+            except KeyError:
+                results[idx] = KeyError(
+                    "Texture {} not found within FS".format(tex_name))
+                continue
+            results[idx] = cache.get(file_infos[idx], reduce)
+        if results[idx] is None:
+            pending.append(idx)
+
+    pending_names = [tex_names[idx] for idx in pending]
+    if jobs == 1 or len(pending_names) < 2:
+        colors = [_try_calculate_color(fs, tex_name, reduce)
+                      for tex_name in pending_names]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs,
+                initializer=_init_worker,
+                initargs=(fs.pk3_paths, fs.index_path)) as executor:
+            colors = list(executor.map(_worker_calculate_color,
+                                       pending_names,
+                                       itertools.repeat(reduce),
+                                       chunksize=4))
+
+    q3.instrument.count("color-cache-hits", len(tex_names) - len(pending) -
+                        sum(isinstance(c, Exception) for c in results))
+    for idx, color in zip(pending, colors):
+        results[idx] = color
+        if cache is not None and not isinstance(color, Exception):
+            cache.put(file_infos[idx], reduce, color)
+
+    q3.instrument.count("textures-resolved",
+                        sum(not isinstance(c, Exception) for c in results))
+    q3.instrument.count("textures-missing",
+                        sum(isinstance(c, KeyError) for c in results))
+    q3.instrument.count("textures-failed",
+                        sum(isinstance(c, Exception) and
+                                not isinstance(c, KeyError)
+                            for c in results))
+
+    return results
+
+
+# Filesystem used by `calculate_colors` worker processes.
+_worker_fs = None
+
+
+def _init_worker(pk3_paths, index_path):
+    global _worker_fs
+    q3.instrument.reset()
+    _worker_fs = q3.fs.FileSystem(pk3_paths, index_path=index_path)
+
+
+def _worker_calculate_color(tex_name, reduce):
+    return _try_calculate_color(_worker_fs, tex_name, reduce)
+
+
+def _try_calculate_color(fs, tex_name, reduce):
+    try:
+        return _calculate_color(fs, tex_name, reduce)
+    except Exception as e:
+        return e
+
+
+def _calculate_color(fs, tex_name, reduce=1):
     tex_file = _open_tex_file(fs, tex_name)
     
     im = Image.open(tex_file)
 
-    # This seems like an efficient method in terms of offloading as much work
-    # as possible to C: Calculate the histogram, and then sum the respective
-    # components. Finally, each sum by the number of pixels to obtain the
-    # average.
-
-    im = im.convert("RGB")
-    hist = im.histogram()
-    def _component_average(comp_hist):
-        return float(sum(val * count
-                    for val, count in enumerate(comp_hist))) / (
-                                256. * im.size[0] * im.size[1])
-    return tuple(_component_average(hist[(256 * c):(256 * (c + 1))])
-                    for c in range(3))
+    if reduce > 1:
+        # Ask the decoder for a downscaled image. Only the JPEG decoder
+        # supports this, and only for some scales, so reduce the image
+        # further if necessary.
+        target_size = (max(1, im.size[0] // reduce),
+                       max(1, im.size[1] // reduce))
+        im.draft("RGB", target_size)
+        im = im.convert("RGB")
+        factor = min(im.size[0] // target_size[0],
+                     im.size[1] // target_size[1])
+        if factor > 1:
+            im = im.reduce(factor)
+    else:
+        im = im.convert("RGB")
+
+    # `ImageStat` calculates the mean from the image's histogram, so the work
+    # is done in C.
+    return tuple(m / 256. for m in ImageStat.Stat(im).mean)
 
 
 def _parse_args(in_args):
@@ -91,36 +316,118 @@ def _parse_args(in_args):
     parser.add_argument("--dir", "-d", 
                         help="Output dir for HTML resources",
                         required=True)
+    parser.add_argument("--profile", metavar="FILE",
+                        help="Write the time and peak memory taken by each "
+                             "stage, and counts of textures, to FILE as "
+                             "JSON. - writes to stderr")
+    add_color_cache_args(parser)
+    add_pk3_index_args(parser)
 
     return parser.parse_args(in_args)
 
+def add_color_cache_args(parser):
+    """
+    Add arguments for `color_cache_from_args`, and a `--color-reduce` argument
+    for `calculate_color`'s `reduce` argument, to an argument parser.
+
+    """
+    parser.add_argument("--color-reduce", type=int, default=1,
+                        help="Factor by which to reduce the size of textures "
+                             "before averaging their colors, for speed at "
+                             "the cost of accuracy. Only JPEGs are decoded "
+                             "at the reduced size; other formats gain little. "
+                             "(default: 1, which gives exact colors)")
+    parser.add_argument("--color-cache",
+                        help="Texture color cache file (default: {})".format(
+                            _default_cache_path()))
+    parser.add_argument("--no-color-cache",
+                        help="Do not use the texture color cache",
+                        action='store_true')
+
+def add_pk3_index_args(parser):
+    """
+    Add arguments for `pk3_index_path_from_args` to an argument parser.
+
+    """
+    parser.add_argument("--pk3-index", metavar="PATH",
+                        help="Index of pk3 directories (default: {})".format(
+                            q3.fs.default_index_path()))
+    parser.add_argument("--no-pk3-index",
+                        help="Do not use the pk3 index",
+                        action='store_true')
+
+def pk3_index_path_from_args(args):
+    """
+    Return the `index_path` to pass to `q3.fs.FileSystem`, as configured by
+    command line arguments.
+
+    """
+    if args.no_pk3_index:
+        return None
+    if args.pk3_index is None:
+        return q3.fs.default_index_path()
+    return args.pk3_index
+
+def color_cache_from_args(args):
+    """
+    Return a `ColorCache` as configured by command line arguments, or `None`
+    if caching is disabled or the cache cannot be opened.
+
+    """
+    if args.no_color_cache:
+        return None
+    try:
+        return ColorCache(args.color_cache)
+    except (OSError, sqlite3.Error) as e:
+        # The cache only saves time, so carry on without it.
+        sys.stderr.write("Warning: Could not open the texture color cache, "
+                         "so it will not be used: {}\n".format(e))
+        return None
+
 def _color_to_hex(color):
     return "#{}".format("".join("%02X" % int(255. * c) for c in color))
 
 def main(argv):
     args = _parse_args(argv)
+    with q3.instrument.profiling_to_file(args.profile):
+        _write_html(args)
+
 
+def _write_html(args):
     images_dir = os.path.join(args.dir, "images")
     os.makedirs(images_dir, exist_ok=True)
-    html_file = open(os.path.join(args.dir, "index.html"), "w")
+    html_file = q3.instrument.CountingWriter(
+        open(os.path.join(args.dir, "index.html"), "w"), "chars-written")
 
-    fs = q3.fs.FileSystem.from_dir(args.baseq3)
+    fs = q3.fs.FileSystem.from_dir(args.baseq3,
+                                   index_path=pk3_index_path_from_args(args))
 
-    with fs.open("maps/{}.bsp".format(args.map)) as bsp_file:
-        bsp = q3.bsp.Bsp(bsp_file)
-        for tex_name in (tex.name for tex in bsp.textures):
-            try:
-                color = calculate_color(fs, tex_name)
-            except KeyError as e:
-                print("<p>!! {}</p>".format(e), file=html_file)
-            else:
-                print("<p>{} {}</p>".format(tex_name, color), file=html_file)
-                print('<div align="center" '
-                      'style="padding:100px;background-color:{};width:100%;">'
-                        .format(_color_to_hex(color)), file=html_file)
-                print('<img src="images/{}" />'.format(
-                    _tex_name_to_image_name(tex_name)), file=html_file)
-                print('</div>', file=html_file)
+    cache = color_cache_from_args(args)
+    try:
+        _write_colors(fs, args, html_file, images_dir, cache)
+    finally:
+        html_file.close()
+        if cache is not None:
+            cache.close()
+
+
+def _write_colors(fs, args, html_file, images_dir, cache):
+    bsp = q3.bsp.Bsp(fs.map("maps/{}.bsp".format(args.map)))
+    for tex_name in (tex.name for tex in bsp.textures):
+        try:
+            color = calculate_color(fs, tex_name, cache,
+                                    reduce=args.color_reduce)
+        except KeyError as e:
+            print("<p>!! {}</p>".format(e), file=html_file)
+        else:
+            print("<p>{} {}</p>".format(tex_name, color), file=html_file)
+            print('<div align="center" '
+                  'style="padding:100px;background-color:{};width:100%;">'
+                    .format(_color_to_hex(color)), file=html_file)
+            print('<img src="images/{}" />'.format(
+                _tex_name_to_image_name(tex_name)), file=html_file)
+            print('</div>', file=html_file)
+            with q3.instrument.stage("save-images"):
                 _save_image(fs, tex_name, images_dir)
 
 
@@ -0,0 +1,88 @@
+"""
+Write a scene's geometry as a Wavefront OBJ file, with an optional MTL file
+of its materials.
+
+Scenes are as described in `povray.sdl`, and must have a `mesh` attribute.
+Only the geometry and materials are written: cameras and lights have no
+representation in OBJ.
+
+Each material becomes an MTL material of the same name, with its color as
+the diffuse color. Whitespace in names is replaced with underscores.
+Coordinates are written as they are in the scene.
+
+"""
+
+__all__ = (
+    'write',
+)
+
+
+import array
+import itertools
+import operator
+import re
+
+import emitter
+
+
+def _mtl_name(name):
+    return re.sub(r"\s", "_", name)
+
+
+def _usemtl_lines(material_indices, mtl_names):
+    """
+    Generate a `usemtl` line for each run of faces with the same material,
+    along with the index of the run's first face.
+
+    """
+    face_idx = 0
+    for mat_idx, run in itertools.groupby(material_indices):
+        yield face_idx, "usemtl {}".format(mtl_names[mat_idx])
+        face_idx += sum(1 for _ in run)
+
+
+def _write_mtl(mtl_file, materials):
+    with emitter.Emitter(mtl_file) as mtl_emitter:
+        written = set()
+        for mat in materials:
+            name = _mtl_name(mat.name)
+            if name in written:
+                continue
+            written.add(name)
+            mtl_emitter.line("newmtl {}".format(name))
+            mtl_emitter.line("Kd {} {} {}".format(*mat.color))
+            mtl_emitter.line("")
+
+
+def write(obj_file, scene, mtl_file=None, mtl_name=None):
+    """
+    Write a scene's mesh to an OBJ file.
+
+    If `mtl_file` is given, the scene's materials are written to it in MTL
+    format. `mtl_name` is the name by which the OBJ file refers to the MTL
+    file, which defaults to `mtl_file`'s name.
+
+    """
+    mesh = scene.mesh
+    positions = mesh.positions
+    if mtl_file is not None:
+        _write_mtl(mtl_file, mesh.materials)
+        if mtl_name is None:
+            mtl_name = mtl_file.name
+
+    # OBJ vertex indices start at 1.
+    indices = array.array('i', map(operator.add, mesh.indices,
+                                   itertools.repeat(1)))
+
+    with emitter.Emitter(obj_file) as obj_emitter:
+        if mtl_name is not None:
+            obj_emitter.line("mtllib {}".format(mtl_name))
+        spec = emitter.float_spec(positions)
+        obj_emitter.rows("v {0} {0} {0}".format(spec), positions, 3)
+
+        # `usemtl` applies to all subsequent faces, so only output it when the
+        # material changes.
+        mtl_names = [_mtl_name(mat.name) for mat in mesh.materials]
+        obj_emitter.rows("f %d %d %d", indices, 3,
+                         headers=_usemtl_lines(mesh.material_indices,
+                                               mtl_names))
@@ -0,0 +1,124 @@
+"""
+Write a scene's geometry as a binary little-endian PLY file.
+
+Scenes are as described in `povray.sdl`, and must have a `mesh` attribute.
+Only the geometry and materials are written: cameras and lights have no
+representation in PLY.
+
+The file has three elements:
+    .. vertex:: The `x`, `y` and `z` coordinates of each of the mesh's
+        vertices, as floats.
+    .. face:: The `vertex_indices` of each triangle, followed by its
+        `material_index`, an index into the material element.
+    .. material:: The `red`, `green` and `blue` components of each of the
+        mesh's materials, as floats in the range 0 - 1. Each material's name
+        is given in a comment in the header.
+
+Coordinates are written as they are in the scene.
+
+"""
+
+__all__ = (
+    'write',
+)
+
+
+import array
+import sys
+
+
+# Number of faces packed into each write of the face element.
+_FACES_PER_CHUNK = 1 << 16
+
+# Size of a face record: a uchar vertex count, 3 vertex indices and a
+# material index.
+_FACE_SIZE = 1 + 3 * 4 + 4
+
+
+def _le_array(typecode, values):
+    """
+    Return `values` as an `array.array` of `typecode`, in little-endian byte
+    order.
+
+    `values` is returned as is if it is already such an array.
+
+    """
+    if (sys.byteorder == "little" and isinstance(values, array.array) and
+            values.typecode == typecode):
+        return values
+    values = array.array(typecode, values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def _header(mesh):
+    lines = [
+        "ply",
+        "format binary_little_endian 1.0",
+    ]
+    lines.extend("comment material {} {}".format(idx, mat.name)
+                     for idx, mat in enumerate(mesh.materials))
+    lines.extend([
+        "element vertex {}".format(len(mesh.positions) // 3),
+        "property float x",
+        "property float y",
+        "property float z",
+        "element face {}".format(len(mesh.material_indices)),
+        "property list uchar int vertex_indices",
+        "property int material_index",
+        "element material {}".format(len(mesh.materials)),
+        "property float red",
+        "property float green",
+        "property float blue",
+        "end_header",
+    ])
+    return "".join(line + "\n" for line in lines).encode("ascii")
+
+
+def _face_chunks(indices, material_indices):
+    """
+    Generate the face element's records, packed into chunks of bytes.
+
+    The records are not aligned, so each byte of the indices is copied to
+    its place in the records by a strided slice assignment.
+
+    """
+    index_bytes = memoryview(indices).cast("B")
+    mat_bytes = memoryview(material_indices).cast("B")
+    num_tris = len(material_indices)
+    for start in range(0, num_tris, _FACES_PER_CHUNK):
+        end = min(start + _FACES_PER_CHUNK, num_tris)
+        chunk = bytearray(_FACE_SIZE * (end - start))
+        chunk[0::_FACE_SIZE] = b"\x03" * (end - start)
+        tri_bytes = index_bytes[12 * start:12 * end]
+        for i in range(12):
+            chunk[1 + i::_FACE_SIZE] = tri_bytes[i::12]
+        mat_idx_bytes = mat_bytes[4 * start:4 * end]
+        for i in range(4):
+            chunk[13 + i::_FACE_SIZE] = mat_idx_bytes[i::4]
+        yield chunk
+
+
+def write(ply_file, scene):
+    """
+    Write a scene's mesh to a binary file in PLY format.
+
+    The vertex and material elements are each written with a single write
+    call, and the face element is written in large chunks.
+
+    """
+    mesh = scene.mesh
+    num_tris = len(mesh.material_indices)
+    positions = _le_array('f', mesh.positions)
+    indices = _le_array('i', mesh.indices)
+    material_indices = _le_array('i', mesh.material_indices)
+    assert len(indices) == 3 * num_tris
+
+    ply_file.write(_header(mesh))
+    ply_file.write(positions.tobytes())
+    for chunk in _face_chunks(indices, material_indices):
+        ply_file.write(chunk)
+    ply_file.write(_le_array('f', (component
+                                       for mat in mesh.materials
+                                       for component in mat.color)).tobytes())
@@ -4,6 +4,8 @@
 Scene object attributes:
     .. materials:: A mapping of material names onto materials.
     .. tris::  An iterable of triangle objects (see below).
+    .. mesh:: (Optional.) The same triangles as `tris`, as a mesh object (see
+        below).
     .. camera:: A camera object (see below).
     .. lights:: An iterable of light objects (see below).
 
@@ -12,6 +14,13 @@ object is a triple of coordinates. A triangle also has the following
 attributes::
     .. material:: A material object (see below).
 
+A mesh object has the following attributes::
+    .. positions:: A flat sequence of vertex coordinates, 3 per vertex.
+    .. indices:: A flat sequence of indices into the vertices, 3 per triangle.
+    .. material_indices:: A sequence holding an index into `materials` for
+        each triangle.
+    .. materials:: A sequence of material objects.
+
 A camera object has the following attributes::
     .. type:: (Optional.) An instance of `CameraType` describing the camera type.
     .. up:: (Optional.) One of 'x', 'y', or 'z'
@@ -30,11 +39,22 @@ A material object has the following attributes::
     .. color:: An RGB triple of colour value in the range 0 - 1, representing
         the surface color.
 
+A region object, describing part of a scene's geometry written to its own
+include file, has the following attributes::
+    .. name:: The SDL identifier the region's object is declared as.
+    .. include:: The name of the region's include file, as referred to by the
+        scene file.
+    .. bounds:: A pair of the minimum and maximum corners of a box enclosing
+        the region.
+    .. mesh:: A mesh object of the region's triangles. This is only needed
+        by `write_region`.
+
 """
 
 
 __all__ = (
     'write',
+    'write_region',
     'CameraType',
 )
 
@@ -42,6 +62,13 @@ __all__ = (
 import contextlib
 import random
 
+import emitter
+
+
+# Scenes with at least this many triangles are written as a single `mesh2`
+# object by default, if they provide a mesh.
+_MESH2_MIN_TRIS = 1000
+
 
 def _random_color():
     return (random.random(), random.random(), random.random(),)
@@ -81,35 +108,62 @@ def _element_writer(meth):
     comments for the object, should any exist.
 
     """
-    def _wrapped(self, element):
+    def _wrapped(self, element, *args, **kwargs):
         self._write_comment(element)
-        meth(self, element)
+        meth(self, element, *args, **kwargs)
 
     return _wrapped
 
 
 class _SdlWriter():
-    def __init__(self, sdl_file, scene):
+    def __init__(self, sdl_emitter, scene, mesh2, regions=None):
         self._scene = scene
-        self._sdl_file = sdl_file
-        self._indent = 0
+        self._emitter = sdl_emitter
+        self._mesh2 = mesh2
+        self._regions = regions
 
     def _output_line(self, line):
-        self._sdl_file.write("  " * self._indent + line + "\n")
+        self._emitter.line(line)
 
     @contextlib.contextmanager
     def _block(self, name):
         """Context manager to print a block."""
         self._output_line(name)
         self._output_line("{")
-        self._indent += 1
-        yield
-        self._indent -= 1
+        with self._emitter.indented():
+            yield
         self._output_line("}")
 
     def _output_lines(self, lines):
-        for line in lines:
-            self._output_line(line)
+        self._emitter.lines(lines)
+
+    def _output_list(self, items):
+        """
+        Output a comma separated list, one item per line, preceded by the
+        number of items.
+
+        """
+        items = list(items)
+        self._output_line("{},".format(len(items)) if items else "0")
+        self._output_lines(item + "," for item in items[:-1])
+        if items:
+            self._output_line(items[-1])
+
+    def _output_rows(self, row_format, values, row_len):
+        """
+        Output a comma separated list of rows of numbers, one row per line,
+        preceded by the number of rows.
+
+        `row_format` is a printf-style format string for a row of `row_len`
+        values from the flat sequence `values`.
+
+        """
+        num_rows = len(values) // row_len
+        self._output_line("{},".format(num_rows) if num_rows else "0")
+        if num_rows:
+            last_start = (num_rows - 1) * row_len
+            self._emitter.rows(row_format + ",", values[:last_start], row_len)
+            self._output_line(row_format % tuple(values[last_start:]))
 
     def _write_comment(self, element):
         if hasattr(element, "comment"):
@@ -119,6 +173,27 @@ class _SdlWriter():
     def _vert_to_str(self, vert):
         return "<{}>".format(", ".join(str(x) for x in vert))
 
+    def _tri_template(self):
+        """
+        Return a format string for a `triangle` block, taking the 9
+        coordinates of its vertices.
+
+        This is equivalent to `_write_tri`, but writing many triangles this
+        way is much faster.
+
+        """
+        return self._emitter.template([
+            (0, "triangle"),
+            (0, "{{"),
+            (1, "<{}, {}, {}>, <{}, {}, {}>, <{}, {}, {}>"),
+            (1, "texture"),
+            (1, "{{"),
+            (2, "pigment {{ color <1., 1., 1.> }}"),
+            (2, "finish {{ ambient .0 diffuse 1. }}"),
+            (1, "}}"),
+            (0, "}}"),
+        ])
+
     @_element_writer
     def _write_tri(self, tri):
         with self._block("triangle"):
@@ -133,6 +208,61 @@ class _SdlWriter():
                 self._output_line("pigment { color <1., 1., 1.> }")
                 self._output_line("finish { ambient .0 diffuse 1. }") 
 
+    def _write_tris(self, tris):
+        template = self._tri_template()
+        write = self._emitter.write
+        for tri in tris:
+            if hasattr(tri, "comment"):
+                self._write_tri(tri)
+                continue
+            a, b, c = tri
+            write(template.format(*a, *b, *c))
+
+    def _material_texture_str(self, material):
+        return ("texture {{ pigment {{ color {} }} "
+                "finish {{ ambient .0 diffuse 1. }} }}".format(
+                    self._vert_to_str(material.color)))
+
+    @_element_writer
+    def _write_mesh2(self, mesh, bounds=None):
+        with self._block("mesh2"):
+            positions = mesh.positions
+            indices = mesh.indices
+            material_indices = mesh.material_indices
+
+            with self._block("vertex_vectors"):
+                self._output_rows(
+                    "<{0}, {0}, {0}>".format(emitter.float_spec(positions)),
+                    positions, 3)
+
+            with self._block("texture_list"):
+                self._output_list(self._material_texture_str(mat)
+                                      for mat in mesh.materials)
+
+            # Interleave each triangle's material index with its vertex
+            # indices, so that the rows can be formatted in bulk.
+            num_tris = len(material_indices)
+            face_values = [0] * (4 * num_tris)
+            for i in range(3):
+                face_values[i::4] = indices[i:3 * num_tris:3]
+            face_values[3::4] = material_indices
+            with self._block("face_indices"):
+                self._output_rows("<%d, %d, %d>, %d", face_values, 4)
+
+            if bounds is not None:
+                self._output_line("bounded_by {{ box {{ {}, {} }} }}".format(
+                    *map(self._vert_to_str, bounds)))
+
+    def _write_region_ref(self, region):
+        # Regions can be left out of a render by declaring `Skip_<name>`, for
+        # example with POV-Ray's `Declare=Skip_<name>=1` option.
+        self._output_line("// {} bounds: {}, {}".format(
+            region.name, *map(self._vert_to_str, region.bounds)))
+        self._output_line("#ifndef (Skip_{})".format(region.name))
+        self._output_line('#include "{}"'.format(region.include))
+        self._output_line("object {{ {} }}".format(region.name))
+        self._output_line("#end")
+
     @_element_writer
     def _write_camera(self, cam):
         with self._block("camera"):
@@ -168,15 +298,57 @@ class _SdlWriter():
         self._write_camera(self._scene.camera)
         for light in self._scene.lights:
             self._write_light(light)
-        for tri in self._scene.tris:
-            self._write_tri(tri)
-
-def write(sdl_file, scene):
+        if self._regions is not None:
+            for region in self._regions:
+                self._write_region_ref(region)
+        elif self._use_mesh2():
+            self._write_mesh2(self._scene.mesh)
+        else:
+            self._write_tris(self._scene.tris)
+
+    def write_region(self, region):
+        self._output_line("#declare {} =".format(region.name))
+        self._write_mesh2(region.mesh, bounds=region.bounds)
+
+    def _use_mesh2(self):
+        if self._mesh2 is not None:
+            return self._mesh2
+        return (hasattr(self._scene, "mesh") and
+                len(self._scene.mesh.material_indices) >= _MESH2_MIN_TRIS)
+
+def write(sdl_file, scene, mesh2=None, regions=None):
     """
     Write a scene to a SDL file
 
+    If `mesh2` is true, the scene's geometry is written as a single `mesh2`
+    object using the scene's `mesh` attribute, with a texture per material.
+    If it is false a `triangle` object is written for each of the scene's
+    `tris`. By default `mesh2` is used for large scenes that have a `mesh`.
+
+    Alternatively, if `regions` is given the scene's geometry is not written.
+    Instead, each region's include file is included and its object added to
+    the scene. The include files are written separately, by `write_region`.
+    A region is skipped if `Skip_<name>` is declared.
+
+    Output is buffered, and written to `sdl_file` in large chunks.
+
+    """
+
+    with emitter.Emitter(sdl_file) as sdl_emitter:
+        sdl_writer = _SdlWriter(sdl_emitter, scene, mesh2, regions)
+        sdl_writer.write()
+
+
+def write_region(sdl_file, region):
+    """
+    Write a region of a scene's geometry to an SDL include file.
+
+    The region's mesh is written as a `mesh2` object bounded by the region's
+    box, and declared with the region's name.
+
     """
 
-    sdl_writer = _SdlWriter(sdl_file, scene)
-    sdl_writer.write()
+    with emitter.Emitter(sdl_file) as sdl_emitter:
+        sdl_writer = _SdlWriter(sdl_emitter, None, mesh2=True)
+        sdl_writer.write_region(region)
 
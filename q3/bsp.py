@@ -1,8 +1,17 @@
 import abc
+import array
 import collections
+import functools
+import io
+import itertools
+import math
+import mmap
+import os
 import struct
+import sys
 
 from . import ents
+from . import instrument
 
 """
 Read a BSP file.
@@ -13,6 +22,14 @@ Please see http://www.mralligator.com/q3/ for details of the file format.
 
 __all__ = (
     'Bsp',
+    'FaceArrays',
+    'FaceBounds',
+    'LeafArrays',
+    'Mesh',
+    'NodeArrays',
+    'PlaneArrays',
+    'VertexArrays',
+    'VisData',
 )
     
 
@@ -55,6 +72,13 @@ class _FaceType:
     MESH = 3
     BILLBOARD = 4
 
+    NAMES = {
+        POLYGON: "polygon",
+        PATCH: "patch",
+        MESH: "mesh",
+        BILLBOARD: "billboard",
+    }
+
 _lump_classes = {}
 
 
@@ -70,12 +94,19 @@ class _Lump(metaclass=abc.ABCMeta):
     Abstract base class for all lump readers classes.
 
     """
-    def __init__(self, bsp, bsp_file, offset, length):
-        """Initialize the lump."""
+    # Names of the `Bsp` attributes that this lump sets when read.
+    _attrs = ()
+
+    def __init__(self, bsp, data):
+        """
+        Initialize the lump.
+
+        `data` is a memoryview of the lump's bytes within the BSP file.
+
+        """
         self._bsp = bsp
-        self._bsp_file = bsp_file
-        self._offset = offset
-        self._length = length
+        self._data = data
+        self._length = len(data)
 
     @abc.abstractmethod
     def _read(self):
@@ -87,6 +118,15 @@ class _Lump(metaclass=abc.ABCMeta):
         """
         raise NotImplementedError
 
+    def _lump_bytes(self):
+        """
+        Return the entire contents of this lump as a memoryview.
+
+        No data is copied.
+
+        """
+        return self._data
+
 class _StructLump(_Lump):
     """
     A lump that is a sequence of fixed length records, each of which can be
@@ -96,18 +136,13 @@ class _StructLump(_Lump):
 
     def _records(self):
         """
-        Generate bytes objects, each one containing the data for a record from
-        this chunk.
+        Generate tuples, each one containing the unpacked fields of a record
+        from this chunk.
         
         """
-        self._bsp_file.seek(self._offset)
         rec_size = struct.calcsize(self._struct_fmt)
         assert self._length % rec_size == 0
-        for idx in range(self._length // rec_size):
-            out = self._bsp_file.read(rec_size)
-            assert len(out) == rec_size, "{} != {}".format(
-                len(out), rec_size)
-            yield out
+        return struct.iter_unpack(self._struct_fmt, self._lump_bytes())
     
     @abc.abstractmethod
     def _start_lump(self):
@@ -117,30 +152,94 @@ class _StructLump(_Lump):
     def _read_from_unpacked(self, unpacked):
         raise NotImplementedError
 
-    def _read_rec(self, rec_bytes):
+    def _read(self):
+        """
+        Read the lump.
+
+        Update with the data from the lump.
+        
         """
-        Read a record from the lump.
+        self._start_lump()
+        for unpacked in self._records():
+            self._read_from_unpacked(unpacked)
+
+
+class _ArrayLump(_Lump):
+    """
+    A lump of fixed length records made up entirely of 4-byte words, described
+    by a `struct` module format string. Rather than creating a Python object
+    per record, the lump is decoded into columns of `array.array` objects.
 
-        Update `self._bsp` with the data from the lump.
+    """
 
+    def _words(self, typecode):
         """
-        unpacked = struct.unpack(self._struct_fmt, rec_bytes)
+        Return the lump as a memoryview of 4-byte words of the given type.
 
-        self._read_from_unpacked(unpacked)
+        On little-endian hosts this is a view onto the BSP data, without any
+        copying.
 
-    def _read(self):
         """
-        Read the lump.
+        rec_size = struct.calcsize(self._struct_fmt)
+        assert rec_size % 4 == 0 and self._length % rec_size == 0
+        if sys.byteorder == 'little':
+            return self._lump_bytes().cast(typecode)
 
-        Update with the data from the lump.
-        
+        words = array.array(typecode)
+        words.frombytes(self._lump_bytes())
+        words.byteswap()
+        return memoryview(words)
+
+    def _column(self, words, typecode, field, count=1):
         """
-        self._start_lump()
-        for rec_bytes in self._records():
-            self._read_rec(rec_bytes)
+        Extract a field from every record into a flat array.
+
+        `field` is the word offset of the field within a record, and `count`
+        is the number of consecutive words the field occupies. The result has
+        `count` entries per record.
+
+        """
+        rec_words = struct.calcsize(self._struct_fmt) // 4
+        num_recs = len(words) // rec_words
+        out = array.array(typecode, bytes(4 * count * num_recs))
+        for i in range(count):
+            out[i::count] = array.array(
+                typecode, words[field + i::rec_words].tobytes())
+        return out
+
+
+VertexArrays = collections.namedtuple('VertexArrays',
+    ['positions', 'texcoords', 'normals'])
+
+FaceArrays = collections.namedtuple('FaceArrays',
+    ['texture', 'type', 'vertex', 'n_vertexes', 'meshvert', 'n_meshverts',
+     'patch_width', 'patch_height'])
+
+Mesh = collections.namedtuple('Mesh',
+    ['positions', 'indices', 'tri_textures'])
+
+PlaneArrays = collections.namedtuple('PlaneArrays', ['normals', 'dists'])
+
+NodeArrays = collections.namedtuple('NodeArrays',
+    ['plane', 'children', 'mins', 'maxs'])
+
+LeafArrays = collections.namedtuple('LeafArrays',
+    ['cluster', 'area', 'mins', 'maxs', 'leafface', 'n_leaffaces'])
+
+VisData = collections.namedtuple('VisData', ['n_vecs', 'sz_vecs', 'vecs'])
+
+FaceBounds = collections.namedtuple('FaceBounds', ['mins', 'maxs'])
+
+
+def _swap_yz(xyz):
+    """Swap Y and Z in-place in a flat array of coordinate triples."""
+    y = xyz[1::3]
+    xyz[1::3] = xyz[2::3]
+    xyz[2::3] = y
+
 
 @_lump_class(_LumpEnum.VERTEXES)
-class _VertexLump(_StructLump):
+class _VertexLump(_ArrayLump):
     """
     Please see http://www.mralligator.com/q3/#Vertexes for details of this
     lump.
@@ -148,98 +247,169 @@ class _VertexLump(_StructLump):
     """
 
     _struct_fmt = "<ffffffffffBBBB"
+    _attrs = ('vertex_arrays',)
 
-    def _start_lump(self):
-        self._bsp.verts = []
+    def _read(self):
+        words = self._words('f')
+        positions = self._column(words, 'f', 0, 3)
+        texcoords = self._column(words, 'f', 3, 2)
+        normals = self._column(words, 'f', 7, 3)
 
-    def _read_from_unpacked(self, unpacked): 
         # Backwards ordering due to Quake 3 treating Z as up.
-        self._bsp.verts.append(
-            Vert(x=unpacked[0],
-                 y=unpacked[2],
-                 z=unpacked[1]))
+        _swap_yz(positions)
+        _swap_yz(normals)
+
+        self._bsp.vertex_arrays = VertexArrays(positions=positions,
+                                               texcoords=texcoords,
+                                               normals=normals)
 
 
 @_lump_class(_LumpEnum.MESHVERTS)
-class _MeshVertexLump(_StructLump):
+class _MeshVertexLump(_ArrayLump):
     """
     Please see http://www.mralligator.com/q3/#Meshverts for details of this
     lump.
 
     """
 
-    _struct_fmt = "<I"
+    _struct_fmt = "<i"
+    _attrs = ('meshverts',)
 
-    def _start_lump(self):
-        self._bsp.meshverts = []
-
-    def _read_from_unpacked(self, unpacked): 
-        self._bsp.meshverts.append(unpacked[0])
+    def _read(self):
+        self._bsp.meshverts = self._column(self._words('i'), 'i', 0)
 
 
 @_lump_class(_LumpEnum.FACES)
-class _FaceLump(_StructLump):
+class _FaceLump(_ArrayLump):
     """
     Please see http://www.mralligator.com/q3/#Faces for details of this
     lump.
 
     """
 
-    _struct_fmt = "<IIIIIIIIIIIIffffffffffffII"
+    _struct_fmt = "<iiiiiiiiiiiiffffffffffffii"
+    _attrs = ('face_arrays',)
 
-    def _start_lump(self):
-        self._bsp.faces = []
+    def _read(self):
+        words = self._words('i')
+        self._bsp.face_arrays = FaceArrays(
+            texture=self._column(words, 'i', 0),
+            type=self._column(words, 'i', 2),
+            vertex=self._column(words, 'i', 3),
+            n_vertexes=self._column(words, 'i', 4),
+            meshvert=self._column(words, 'i', 5),
+            n_meshverts=self._column(words, 'i', 6),
+            patch_width=self._column(words, 'i', 24),
+            patch_height=self._column(words, 'i', 25))
+
+
+@_lump_class(_LumpEnum.PLANES)
+class _PlaneLump(_ArrayLump):
+    """
+    Please see http://www.mralligator.com/q3/#Planes for details of this
+    lump.
 
-    def _read_from_unpacked(self, unpacked): 
-        texture_idx = unpacked[0]
-        face_type = unpacked[2]
-        vertex = unpacked[3]
-        n_vertexes = unpacked[4]
-        meshvert = unpacked[5]
-        n_meshverts = unpacked[6]
-        patch_size = (unpacked[24], unpacked[25])
-
-        texture = self._bsp.textures[texture_idx]
-
-        if face_type in (_FaceType.POLYGON, _FaceType.MESH): 
-            # `vertex` and `n_vertex` describe the vertices of the mesh/poly.
-            # `meshverts` and `n_meshverts` describe the triangulation of these
-            # verts.
-            vert_indices = range(vertex, vertex + n_vertexes)
-            verts = [self._bsp.verts[i] for i in vert_indices]
-
-            assert n_meshverts % 3 == 0
-            for idx in range(meshvert, meshvert + n_meshverts, 3):
-                self._bsp.faces.append(
-                        Face(texture=texture,
-                             verts=[verts[self._bsp.meshverts[idx + i]]
-                                        for i in range(3)]))
-        if face_type == _FaceType.PATCH:
-            # `vertex` and `n_vertex` describe the control points of the patch.
-            # The control points are a grid of size `patch_size`.
-            assert patch_size[0] * patch_size[1] == n_vertexes
-
-            verts = { (i, j):
-                         self._bsp.verts[vertex + i + j * patch_size[0]]
-                            for j in range(patch_size[1])
-                                for i in range(patch_size[0])
-                    }
-
-            # No interpolation yet, just triangulate the control points.
-            for j in range(patch_size[1] - 1):
-                for i in range(patch_size[0] - 1):
-                    self._bsp.faces.append(
-                        Face(texture=texture,
-                             verts=[verts[i, j],
-                                    verts[i + 1, j],
-                                    verts[i + 1, j + 1]]))
-                    self._bsp.faces.append(
-                        Face(texture=texture,
-                             verts=[verts[i, j],
-                                    verts[i + 1, j + 1],
-                                    verts[i, j + 1]]))
-        else:
-            pass
+    """
+
+    _struct_fmt = "<ffff"
+    _attrs = ('plane_arrays',)
+
+    def _read(self):
+        words = self._words('f')
+        normals = self._column(words, 'f', 0, 3)
+        _swap_yz(normals)
+        self._bsp.plane_arrays = PlaneArrays(
+            normals=normals,
+            dists=self._column(words, 'f', 3))
+
+
+@_lump_class(_LumpEnum.NODES)
+class _NodeLump(_ArrayLump):
+    """
+    Please see http://www.mralligator.com/q3/#Nodes for details of this
+    lump.
+
+    """
+
+    _struct_fmt = "<iiiiiiiii"
+    _attrs = ('node_arrays',)
+
+    def _read(self):
+        words = self._words('i')
+        mins = self._column(words, 'i', 3, 3)
+        maxs = self._column(words, 'i', 6, 3)
+        _swap_yz(mins)
+        _swap_yz(maxs)
+        self._bsp.node_arrays = NodeArrays(
+            plane=self._column(words, 'i', 0),
+            children=self._column(words, 'i', 1, 2),
+            mins=mins,
+            maxs=maxs)
+
+
+@_lump_class(_LumpEnum.LEAFS)
+class _LeafLump(_ArrayLump):
+    """
+    Please see http://www.mralligator.com/q3/#Leafs for details of this
+    lump.
+
+    """
+
+    _struct_fmt = "<iiiiiiiiiiii"
+    _attrs = ('leaf_arrays',)
+
+    def _read(self):
+        words = self._words('i')
+        mins = self._column(words, 'i', 2, 3)
+        maxs = self._column(words, 'i', 5, 3)
+        _swap_yz(mins)
+        _swap_yz(maxs)
+        self._bsp.leaf_arrays = LeafArrays(
+            cluster=self._column(words, 'i', 0),
+            area=self._column(words, 'i', 1),
+            mins=mins,
+            maxs=maxs,
+            leafface=self._column(words, 'i', 8),
+            n_leaffaces=self._column(words, 'i', 9))
+
+
+@_lump_class(_LumpEnum.LEAFFACES)
+class _LeafFaceLump(_ArrayLump):
+    """
+    Please see http://www.mralligator.com/q3/#Leaffaces for details of this
+    lump.
+
+    """
+
+    _struct_fmt = "<i"
+    _attrs = ('leaffaces',)
+
+    def _read(self):
+        self._bsp.leaffaces = self._column(self._words('i'), 'i', 0)
+
+
+@_lump_class(_LumpEnum.VISDATA)
+class _VisDataLump(_Lump):
+    """
+    Please see http://www.mralligator.com/q3/#Visdata for details of this
+    lump.
+
+    """
+
+    _attrs = ('visdata',)
+
+    def _read(self):
+        data = self._lump_bytes()
+        if len(data) == 0:
+            # Maps compiled without vis information have an empty lump.
+            self._bsp.visdata = None
+            return
+
+        n_vecs, sz_vecs = struct.unpack_from("<ii", data)
+        assert len(data) >= 8 + n_vecs * sz_vecs
+        self._bsp.visdata = VisData(n_vecs=n_vecs,
+                                    sz_vecs=sz_vecs,
+                                    vecs=data[8:8 + n_vecs * sz_vecs])
 
 
 @_lump_class(_LumpEnum.ENTITIES)
@@ -249,10 +419,61 @@ class _EntitiesLump(_Lump):
     lump.
 
     """
+    _attrs = ('entities', '_entity_index')
+
     def _read(self):
-        self._bsp_file.seek(self._offset)
-        ents_str = self._bsp_file.read(self._length).decode('ascii')
-        self._bsp.entities = ents.parse(ents_str)
+        self._bsp.entities = ents.parse(self._lump_bytes())
+        self._bsp._entity_index = _EntityIndex(self._bsp.entities)
+
+
+# Size of the cells of the grid that entities are indexed by origin in.
+_ENT_CELL_SIZE = 512.
+
+
+class _EntityIndex():
+    """
+    Indexes of entities by classname, targetname and origin.
+
+    """
+
+    def _cell(self, point):
+        return tuple(math.floor(c / _ENT_CELL_SIZE) for c in point)
+
+    def __init__(self, entities):
+        self.by_classname = collections.defaultdict(list)
+        self.by_targetname = collections.defaultdict(list)
+        # cells maps grid cells onto the entities whose origins are in them.
+        self.cells = collections.defaultdict(list)
+
+        for ent in entities:
+            if 'classname' in ent:
+                self.by_classname[ent['classname']].append(ent)
+            if 'targetname' in ent:
+                self.by_targetname[ent['targetname']].append(ent)
+            if 'origin' in ent:
+                self.cells[self._cell(ent['origin'])].append(ent)
+
+    def near(self, point, radius):
+        sq_radius = radius * radius
+        cells = None
+        if math.isfinite(radius):
+            lo = self._cell(c - radius for c in point)
+            hi = self._cell(c + radius for c in point)
+            ranges = [range(l, h + 1) for l, h in zip(lo, hi)]
+            if math.prod(map(len, ranges)) <= len(self.cells):
+                cells = (self.cells.get(cell, ())
+                             for cell in itertools.product(*ranges))
+
+        # When the query box covers more cells than are occupied, it is
+        # cheaper to check every entity.
+        if cells is None:
+            cells = self.cells.values()
+
+        for cell_ents in cells:
+            for ent in cell_ents:
+                if sum((a - b) ** 2
+                           for a, b in zip(ent['origin'], point)) <= sq_radius:
+                    yield ent
 
 
 @_lump_class(_LumpEnum.TEXTURES)
@@ -264,6 +485,7 @@ class _TextureLump(_StructLump):
     """
 
     _struct_fmt = "<64sII"
+    _attrs = ('textures',)
 
     def _start_lump(self):
         self._bsp.textures = []
@@ -279,44 +501,681 @@ class _TextureLump(_StructLump):
             contents=unpacked[2]))
 
 
+def _face_tris(bsp, face_idx, face):
+    """
+    Return the triangles of a face as a list of `Face` objects.
+
+    """
+    texture = bsp.textures[face.texture]
+    vertex = face.vertex
+    out = []
+
+    if face.type in (_FaceType.POLYGON, _FaceType.MESH): 
+        # `vertex` and `n_vertex` describe the vertices of the mesh/poly.
+        # `meshverts` and `n_meshverts` describe the triangulation of these
+        # verts.
+        verts = bsp.verts[vertex:vertex + face.n_vertexes]
+
+        assert face.n_meshverts % 3 == 0
+        for idx in range(face.meshvert,
+                         face.meshvert + face.n_meshverts, 3):
+            out.append(
+                    Face(texture=texture,
+                         verts=[verts[bsp.meshverts[idx + i]]
+                                    for i in range(3)]))
+    if face.type == _FaceType.PATCH:
+        positions, indices = bsp.tessellate_patch(face_idx)
+        verts = list(map(Vert._make, zip(positions[0::3],
+                                         positions[1::3],
+                                         positions[2::3])))
+        for idx in range(0, len(indices), 3):
+            out.append(
+                    Face(texture=texture,
+                         verts=[verts[indices[idx + i]] for i in range(3)]))
+
+    return out
+
+
+def _face_tri_indices(bsp, face):
+    """
+    Return the triangles of a polygon or mesh face as a flat array of vertex
+    indices, 3 per triangle, indexing into the BSP's vertices.
+
+    The triangles are the same, and in the same order, as those returned by
+    `_face_tris`.
+
+    """
+    vertex = face.vertex
+
+    if face.type in (_FaceType.POLYGON, _FaceType.MESH): 
+        assert face.n_meshverts % 3 == 0
+        return array.array('i', map(vertex.__add__, bsp.meshverts[
+                    face.meshvert:face.meshvert + face.n_meshverts]))
+
+    return array.array('i')
+
+
+# Maximum number of segments each biquadratic section of a patch is divided
+# into, along each axis.
+_MAX_PATCH_LEVEL = 16
+
+
+@functools.lru_cache()
+def _bezier_weights(level):
+    """
+    Return the quadratic Bezier basis weights for each of `level + 1` evenly
+    spaced parameter values.
+
+    """
+    return [((1 - t) * (1 - t), 2 * t * (1 - t), t * t)
+                for t in (k / level for k in range(level + 1))]
+
+
+def _tessellate_curve(points, level):
+    """
+    Evaluate a chain of quadratic Bezier curves.
+
+    `points` is a list of an odd number of control points: each consecutive
+    (overlapping) triple is a curve. Each curve is divided into `level`
+    segments. The endpoints of adjacent curves are only output once.
+
+    """
+    weights = _bezier_weights(level)[1:]
+    out = [points[0]]
+    for i in range(0, len(points) - 1, 2):
+        (x0, y0, z0), (x1, y1, z1), (x2, y2, z2) = points[i:i + 3]
+        out.extend((w0 * x0 + w1 * x1 + w2 * x2,
+                    w0 * y0 + w1 * y1 + w2 * y2,
+                    w0 * z0 + w1 * z1 + w2 * z2)
+                       for w0, w1, w2 in weights)
+    return out
+
+
+def _curve_deviation(p0, p1, p2):
+    """
+    Return the distance between the midpoint of a quadratic Bezier curve and
+    the midpoint of its chord.
+
+    Dividing the curve into `n` even segments gives a maximum error of this
+    distance divided by `n ** 2`.
+
+    """
+    return 0.5 * math.sqrt(sum((b - 0.5 * (a + c)) ** 2
+                                   for a, b, c in zip(p0, p1, p2)))
+
+
+def _compact_mesh(positions, indices):
+    """
+    Remove unused vertices from a mesh's flat position and index arrays.
+
+    Returns:
+        A new `(positions, indices)` pair. Vertices are ordered by first use.
+
+    """
+    used = list(dict.fromkeys(indices))
+    remap = dict(zip(used, range(len(used))))
+    new_indices = array.array('i', map(remap.__getitem__, indices))
+    new_positions = array.array('f', bytes(3 * 4 * len(used)))
+    for axis in range(3):
+        coords = positions[axis::3]
+        new_positions[axis::3] = array.array('f',
+                                             map(coords.__getitem__, used))
+
+    return new_positions, new_indices
+
+
 _LumpEntry = collections.namedtuple('_LumpEntry', ['offset', 'length'])
 
+
+def _map_source(source):
+    """
+    Return a read-only, byte-formatted memoryview of a BSP source.
+
+    `source` may be a path (`str` or path-like), an object supporting the buffer protocol (eg.
+    `bytes` or an `mmap`), or a binary file-like object. Paths and real files
+    are memory mapped rather than read.
+
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            return _map_source(f)
+
+    try:
+        return memoryview(source).cast('B')
+    except TypeError:
+        pass
+
+    if hasattr(source, "getvalue"):
+        # Copy rather than use `getbuffer`, whose view would stop the
+        # `BytesIO` from being closed while the `Bsp` exists.
+        return memoryview(source.getvalue())
+
+    try:
+        fileno = source.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        source.seek(0)
+        return memoryview(source.read())
+    else:
+        return memoryview(mmap.mmap(fileno, 0, access=mmap.ACCESS_READ))
+
+
+class _LazyLumpAttr():
+    """
+    Descriptor for a `Bsp` attribute that is set by reading a lump.
+
+    The lump is read the first time the attribute is accessed. Reading sets
+    the lump's attributes on the instance, which then take precedence over
+    this (non-data) descriptor until they are unloaded.
+
+    """
+    def __init__(self, lump_num, name):
+        self._lump_num = lump_num
+        self._name = name
+
+    def __get__(self, bsp, owner):
+        if bsp is None:
+            return self
+        bsp._load_lump(self._lump_num)
+        return bsp.__dict__[self._name]
+
+
 class Bsp():
     """
     Represents a BSP file.
 
-    """
+    Lumps are read lazily: each of the attributes below is decoded the first
+    time it (or an attribute depending on it) is accessed, and then cached.
+    `unload` discards a decoded lump.
+
+        .. textures:: A list of `Texture` objects.
+        .. entities:: A list of entity dicts, as returned by `q3.ents.parse`.
+            Entities are indexed when they are read, for the
+            `entities_by_classname`, `entities_by_targetname` and
+            `entities_near` methods.
+        .. verts:: A list of `Vert` objects.
+        .. faces:: A list of triangular `Face` objects. Reading this also
+            reads the textures, vertices and mesh vertices.
+        .. mesh:: The same triangles as `faces`, as an indexed `Mesh`:
+            `positions` holds `vertex_arrays.positions` followed by the
+            vertices of tessellated patches, `indices` holds 3 vertex indices
+            per triangle and `tri_textures` holds the index into `textures` of
+            each triangle. This is much smaller than `faces`, and does not
+            require it to be built.
+
+    Curved patch faces are tessellated according to `patch_tolerance`; see
+    `tessellate_patch`.
+
+    The vertex and face lumps are also available in struct-of-arrays form:
+
+        .. vertex_arrays:: A `VertexArrays` of flat `array.array` objects:
+            `positions` and `normals` hold 3 floats per vertex, `texcoords`
+            holds 2.
+        .. face_arrays:: A `FaceArrays` with one `array.array` entry per face
+            in each field.
+        .. meshverts:: An `array.array` of mesh vertex offsets.
+
+    The BSP tree and visibility information are available in the same form,
+    and are used by `leaf_for_point`, `cluster_visible` and `visible_faces`:
+
+        .. plane_arrays:: A `PlaneArrays`. `normals` has 3 floats per plane.
+        .. node_arrays:: A `NodeArrays`. `children`, `mins` and `maxs` have 2,
+            3 and 3 entries per node respectively.
+        .. leaf_arrays:: A `LeafArrays`. `mins` and `maxs` have 3 entries per
+            leaf.
+        .. leaffaces:: An `array.array` of face indices.
+        .. visdata:: A `VisData` whose `vecs` is a memoryview of the cluster
+            visibility bit vectors, or `None` if the map has no visibility
+            information.
+
+    Like vertices, all vectors have their Y and Z components swapped.
 
-    def _read_lump_entry(self):
-        fmt = "<II"
-        unpacked = struct.unpack(fmt,
-                    self._bsp_file.read(struct.calcsize(fmt)))
-        return _LumpEntry._make(unpacked)
+    """
 
     def _read_lump_dir(self):
-        self._bsp_file.seek(8)
-            
+        fmt = "<II"
         self._lump_dir = {}
         for lump_num in range(_LumpEnum.COUNT):
-            self._lump_dir[lump_num] = self._read_lump_entry()
+            self._lump_dir[lump_num] = _LumpEntry._make(
+                struct.unpack_from(fmt, self._data,
+                                   8 + lump_num * struct.calcsize(fmt)))
+
+    def _lump_data(self, lump_num):
+        entry = self._lump_dir[lump_num]
+        assert entry.offset + entry.length <= len(self._data)
+        return self._data[entry.offset:entry.offset + entry.length]
         
-    def __init__(self, bsp_file): 
-        self._bsp_file = bsp_file
+    def __init__(self, source, patch_tolerance=2.0): 
+        """
+        Load a BSP file.
+
+        `source` may be a path to a BSP file, a buffer containing the file's
+        contents (such as the result of `q3.fs.FileSystem.map`), or a binary
+        file-like object. Lumps are decoded from memoryview slices of the
+        source, so the file's data is not copied before decoding.
+
+        `patch_tolerance` is the maximum distance, in map units, between the
+        triangles made from curved patches and the true curved surfaces.
+        Smaller values give smoother, but more expensive, curves. It must be
+        positive.
+
+        """
+        if not patch_tolerance > 0:
+            raise ValueError("patch_tolerance must be positive, not "
+                             "{!r}".format(patch_tolerance))
+        self._data = _map_source(source)
+        self.patch_tolerance = patch_tolerance
+
+        # _patch_cache maps (face index, level) pairs onto tessellated
+        # patches. See `tessellate_patch`.
+        self._patch_cache = {}
 
         self._read_lump_dir()
 
-        _lump_readers = {
-            lump_num: cls(bsp=self,
-                          bsp_file=self._bsp_file,
-                          offset=self._lump_dir[lump_num].offset,
-                          length=self._lump_dir[lump_num].length)
+        self._lump_readers = {
+            lump_num: cls(bsp=self, data=self._lump_data(lump_num))
             for lump_num, cls in _lump_classes.items()
         }
 
-        _lump_readers[_LumpEnum.TEXTURES]._read()
-        _lump_readers[_LumpEnum.VERTEXES]._read()
-        _lump_readers[_LumpEnum.MESHVERTS]._read()
-        _lump_readers[_LumpEnum.FACES]._read()
-        _lump_readers[_LumpEnum.ENTITIES]._read()
+    def _load_lump(self, lump_num):
+        """Read a lump, unless it has already been read."""
+        reader = self._lump_readers[lump_num]
+        if not all(attr in self.__dict__ for attr in reader._attrs):
+            with instrument.stage("decode-lumps"):
+                reader._read()
+
+    @functools.cached_property
+    def verts(self):
+        positions = self.vertex_arrays.positions
+        return list(map(Vert._make, zip(positions[0::3],
+                                        positions[1::3],
+                                        positions[2::3])))
+
+    @functools.cached_property
+    def faces(self):
+        return [tri for face_idx, face in enumerate(
+                        map(FaceArrays._make, zip(*self.face_arrays)))
+                    for tri in _face_tris(self, face_idx, face)]
+
+    @instrument.staged("triangulate")
+    def face_tris(self, face_idx):
+        """Return the triangles of a face as a list of `Face` objects."""
+        return _face_tris(self, face_idx, FaceArrays._make(
+                                    col[face_idx] for col in self.face_arrays))
+
+    @functools.cached_property
+    def mesh(self):
+        return self.build_mesh()
+
+    @instrument.staged("triangulate")
+    def build_mesh(self, face_indices=None):
+        """
+        Build a `Mesh` from a subset of the faces.
+
+        With the default `face_indices` of `None` the mesh is the same as the
+        `mesh` attribute. Otherwise it contains only the triangles of the faces
+        whose indices are given, in that order, and only the vertices those
+        triangles use, so vertex indices no longer match those of the BSP.
+
+        """
+        if face_indices is None:
+            face_indices = range(len(self.face_arrays.type))
+
+        bsp_positions = self.vertex_arrays.positions
+        patch_positions = array.array('f')
+        indices = array.array('i')
+        tri_textures = array.array('i')
+        for face_idx in face_indices:
+            face = FaceArrays._make(col[face_idx] for col in self.face_arrays)
+            if face.type == _FaceType.PATCH:
+                # Tessellated patch vertices are added after the BSP's.
+                positions, tri_indices = self.tessellate_patch(face_idx)
+                base = (len(bsp_positions) + len(patch_positions)) // 3
+                patch_positions.extend(positions)
+                tri_indices = array.array('i',
+                                          map(base.__add__, tri_indices))
+            else:
+                tri_indices = _face_tri_indices(self, face)
+            indices.extend(tri_indices)
+            tri_textures.extend(
+                array.array('i', (face.texture,)) * (len(tri_indices) // 3))
+
+        if patch_positions:
+            positions = bsp_positions + patch_positions
+        else:
+            positions = bsp_positions
+
+        if not isinstance(face_indices, range):
+            positions, indices = _compact_mesh(positions, indices)
+
+        return Mesh(positions=positions,
+                    indices=indices,
+                    tri_textures=tri_textures)
+
+    def leaf_for_point(self, point):
+        """Return the index of the leaf containing a point."""
+        normals = self.plane_arrays.normals
+        dists = self.plane_arrays.dists
+        planes = self.node_arrays.plane
+        children = self.node_arrays.children
+        x, y, z = point
+
+        idx = 0
+        while idx >= 0:
+            plane = planes[idx]
+            nx, ny, nz = normals[3 * plane:3 * plane + 3]
+            if nx * x + ny * y + nz * z - dists[plane] >= 0:
+                idx = children[2 * idx]
+            else:
+                idx = children[2 * idx + 1]
+
+        return -(idx + 1)
+
+    def cluster_visible(self, from_cluster, to_cluster):
+        """
+        Return whether a cluster is potentially visible from another.
+
+        Negative clusters (ie. leaves outside of the map) and maps without
+        visibility information are treated as seeing everything.
+
+        """
+        if self.visdata is None or from_cluster < 0 or to_cluster < 0:
+            return True
+        byte = self.visdata.vecs[from_cluster * self.visdata.sz_vecs +
+                                 to_cluster // 8]
+        return bool(byte & (1 << (to_cluster % 8)))
+
+    def visible_faces(self, point):
+        """
+        Return a sorted list of the indices of faces in leaves whose clusters
+        are potentially visible from a point.
+
+        """
+        from_cluster = self.leaf_arrays.cluster[self.leaf_for_point(point)]
+        visible_clusters = {}
+        face_indices = set()
+        for leaf, cluster in enumerate(self.leaf_arrays.cluster):
+            if cluster not in visible_clusters:
+                visible_clusters[cluster] = self.cluster_visible(from_cluster,
+                                                                 cluster)
+            if visible_clusters[cluster]:
+                start = self.leaf_arrays.leafface[leaf]
+                face_indices.update(self.leaffaces[
+                    start:start + self.leaf_arrays.n_leaffaces[leaf]])
+
+        return sorted(face_indices)
+
+    @functools.cached_property
+    def face_bounds(self):
+        """
+        The axis-aligned bounding box of each face, as a `FaceBounds`.
+
+        Boxes enclose each face's vertices. For a patch these are its control
+        points, which bound the curved surface and so its tessellation too.
+        Faces without vertices have empty boxes, whose minimums are greater
+        than their maximums.
+
+        """
+        positions = self.vertex_arrays.positions
+        axes = [positions[axis::3] for axis in range(3)]
+        mins = array.array('f')
+        maxs = array.array('f')
+        for vertex, n_vertexes in zip(self.face_arrays.vertex,
+                                      self.face_arrays.n_vertexes):
+            for coords in axes:
+                coords = coords[vertex:vertex + n_vertexes]
+                mins.append(min(coords, default=math.inf))
+                maxs.append(max(coords, default=-math.inf))
+
+        return FaceBounds(mins=mins, maxs=maxs)
+
+    def faces_inside(self, planes, face_indices=None):
+        """
+        Return the indices of faces that are not entirely behind any of a set
+        of planes.
+
+        `planes` is an iterable of `(normal, dist)` pairs. A point `p` is
+        behind a plane if `dot(normal, p) < dist`. Faces are tested using
+        their `face_bounds`, so a face is only removed if its whole bounding
+        box is behind a plane.
+
+        `face_indices` restricts the faces considered, and defaults to all of
+        them. The returned indices are in the same order.
+
+        """
+        mins, maxs = self.face_bounds
+        axes = [(mins[axis::3], maxs[axis::3]) for axis in range(3)]
+        if face_indices is None:
+            face_indices = range(len(self.face_arrays.type))
+
+        out = list(face_indices)
+        for (nx, ny, nz), dist in planes:
+            # For each axis pick the side of the boxes furthest along the
+            # normal, giving the corner of each box furthest in front.
+            xs = axes[0][nx > 0]
+            ys = axes[1][ny > 0]
+            zs = axes[2][nz > 0]
+            out = [face_idx for face_idx in out
+                       if (nx * xs[face_idx] + ny * ys[face_idx] +
+                           nz * zs[face_idx]) >= dist]
+
+        return out
+
+    def faces_near(self, point, distance, face_indices=None):
+        """
+        Return the indices of faces within a distance of a point.
+
+        As with `faces_inside`, faces are tested using their `face_bounds`,
+        and `face_indices` restricts the faces considered.
+
+        """
+        mins, maxs = self.face_bounds
+        if face_indices is None:
+            face_indices = range(len(self.face_arrays.type))
+
+        sq_dists = [0.] * len(self.face_arrays.type)
+        for axis, coord in enumerate(point):
+            for face_idx, lo, hi in zip(range(len(sq_dists)),
+                                        mins[axis::3], maxs[axis::3]):
+                d = max(lo - coord, coord - hi, 0.)
+                sq_dists[face_idx] += d * d
+
+        return [face_idx for face_idx in face_indices
+                    if sq_dists[face_idx] <= distance * distance]
+
+    def partition_faces(self, max_faces, face_indices=None):
+        """
+        Split faces into spatially compact regions.
+
+        The faces are divided with a k-d tree over the centres of their
+        `face_bounds`: a region of more than `max_faces` faces is split in
+        half at the median centre along the axis in which the centres are
+        most spread out, and each half is split in the same way. Faces
+        without vertices are left out.
+
+        `face_indices` restricts the faces considered, and defaults to all of
+        them.
+
+        Returns:
+            A list of regions, each a sorted list of face indices. The same
+            faces always give the same regions, in the same order.
+
+        """
+        mins, maxs = self.face_bounds
+        if face_indices is None:
+            face_indices = range(len(self.face_arrays.type))
+        centres = [[(lo + hi) / 2. for lo, hi in zip(mins[axis::3],
+                                                      maxs[axis::3])]
+                       for axis in range(3)]
+
+        regions = []
+        stack = [[face_idx for face_idx in face_indices
+                      if mins[3 * face_idx] <= maxs[3 * face_idx]]]
+        while stack:
+            faces = stack.pop()
+            if len(faces) <= max_faces:
+                if faces:
+                    regions.append(sorted(faces))
+                continue
+
+            def spread(axis):
+                coords = list(map(centres[axis].__getitem__, faces))
+                return max(coords) - min(coords)
+            axis = max(range(3), key=spread)
+            faces.sort(key=centres[axis].__getitem__)
+            mid = len(faces) // 2
+            # Push the second half first, so that the first half is split
+            # first and regions come out in order along each split axis.
+            stack.append(faces[mid:])
+            stack.append(faces[:mid])
+
+        return regions
+
+    def face_type_counts(self, face_indices=None):
+        """
+        Return a dict mapping face type names ("polygon", "patch", "mesh" and
+        "billboard") onto the number of faces of that type.
+
+        `face_indices` restricts the faces counted, and defaults to all of
+        them.
+
+        """
+        types = self.face_arrays.type
+        if face_indices is None:
+            face_indices = range(len(types))
+        counts = collections.Counter(types[f] for f in face_indices)
+        return {name: counts[face_type]
+                    for face_type, name in _FaceType.NAMES.items()}
+
+    def face_tri_count(self, face_idx):
+        """Return the number of triangles a face is made of."""
+        face = FaceArrays._make(col[face_idx] for col in self.face_arrays)
+        if face.type in (_FaceType.POLYGON, _FaceType.MESH):
+            return face.n_meshverts // 3
+        if face.type == _FaceType.PATCH:
+            level = self.patch_level(face_idx)
+            return (2 * (face.patch_width // 2) * (face.patch_height // 2) *
+                    level * level)
+        return 0
+
+    def entities_by_classname(self, classname):
+        """Return a list of the entities with a given classname."""
+        return list(self._entity_index.by_classname.get(classname, ()))
+
+    def entities_by_targetname(self, targetname):
+        """Return a list of the entities with a given targetname."""
+        return list(self._entity_index.by_targetname.get(targetname, ()))
+
+    def entities_near(self, point, radius):
+        """
+        Return a list of the entities whose origins are within a distance of a
+        point.
+
+        """
+        return list(self._entity_index.near(point, radius))
+
+    def _patch_control_points(self, face):
+        positions = self.vertex_arrays.positions
+        width, height = face.patch_width, face.patch_height
+        assert width * height == face.n_vertexes
+        assert width % 2 == 1 and height % 2 == 1
+        points = [tuple(positions[3 * v:3 * v + 3])
+                      for v in range(face.vertex, face.vertex + width * height)]
+        return [points[j * width:(j + 1) * width] for j in range(height)]
+
+    def patch_level(self, face_idx):
+        """
+        Return the number of segments that each biquadratic section of a
+        patch face is divided into along each axis, when tessellated.
+
+        The level is the smallest that keeps the tessellated surface within
+        `patch_tolerance` units of the true curved surface, so larger and more
+        curved patches are given higher levels.
+
+        """
+        face = FaceArrays._make(col[face_idx] for col in self.face_arrays)
+        rows = self._patch_control_points(face)
+        cols = [list(col) for col in zip(*rows)]
+        deviation = max(_curve_deviation(*line[i:i + 3])
+                            for line in rows + cols
+                            for i in range(0, len(line) - 1, 2))
+
+        level = math.ceil(math.sqrt(deviation / self.patch_tolerance))
+        return max(1, min(_MAX_PATCH_LEVEL, level))
+
+    @instrument.staged("tessellate")
+    def tessellate_patch(self, face_idx, level=None):
+        """
+        Tessellate a patch face into triangles.
+
+        The patch's control points are treated as a grid of biquadratic Bezier
+        surfaces, each of which is divided into a `level` by `level` grid of
+        quads, each split into two triangles. `level` defaults to the level
+        given by `patch_level`.
+
+        Results are cached by face index and level.
+
+        Returns:
+            A pair `(positions, indices)`. `positions` is a flat array of
+            vertex coordinates, 3 per vertex, and `indices` is a flat array of
+            indices into `positions`, 3 per triangle.
+
+        """
+        if level is None:
+            level = self.patch_level(face_idx)
+        key = (face_idx, level)
+        if key in self._patch_cache:
+            return self._patch_cache[key]
+
+        face = FaceArrays._make(col[face_idx] for col in self.face_arrays)
+        assert face.type == _FaceType.PATCH
+
+        # Evaluate along each row of control points, and then evaluate down
+        # each column of the results.
+        rows = [_tessellate_curve(row, level)
+                    for row in self._patch_control_points(face)]
+        cols = [_tessellate_curve(list(col), level) for col in zip(*rows)]
+        width, height = len(cols), len(cols[0])
+
+        positions = array.array('f', (c for j in range(height)
+                                          for col in cols
+                                          for c in col[j]))
+        indices = array.array('i')
+        for j in range(height - 1):
+            for i in range(width - 1):
+                v = i + j * width
+                indices.extend((v, v + 1, v + 1 + width,
+                                v, v + 1 + width, v + width))
+
+        self._patch_cache[key] = (positions, indices)
+        return positions, indices
+
+    def unload(self, name):
+        """
+        Discard a decoded lump, releasing its memory.
+
+        `name` is the name of any attribute set by the lump, eg. `verts`. All
+        attributes set by the same lump are discarded. The lump will be read
+        again if one of its attributes is subsequently accessed. The derived
+        `verts`, `faces`, `mesh` and `face_bounds` attributes can also be
+        discarded, individually.
+
+        """
+        if isinstance(getattr(type(self), name, None),
+                      functools.cached_property):
+            self.__dict__.pop(name, None)
+            return
+
+        for reader in self._lump_readers.values():
+            if name in reader._attrs:
+                for attr in reader._attrs:
+                    self.__dict__.pop(attr, None)
+                break
+        else:
+            raise AttributeError("No lump sets {!r}".format(name))
+
+
+for _lump_num, _cls in _lump_classes.items():
+    for _name in _cls._attrs:
+        setattr(Bsp, _name, _LazyLumpAttr(_lump_num, _name))
 
 
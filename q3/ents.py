@@ -12,95 +12,120 @@ __all__ = (
 class BadEntsString(Exception):
     pass
 
-class _InvalidKeyValue(Exception):
-    pass
-
-_LINE_RE = r'"([^"]*)" "([^"]*)"'
-
-def _parse_key_value(line):
-    m = re.match(_LINE_RE, line)
-
-    if not m:
-        raise _InvalidKeyValue("Does not match {}".format(_LINE_RE))
-
-    return m.groups()
-
-def _ents_gen(ents_lines):
+# Whitespace (including the lump's terminating NUL) and comments. Runs of
+# whitespace are not repeated within the group, and comments must run to the
+# end of their line, so that backtracking when what follows does not match
+# takes linear rather than exponential time.
+_SKIP = r'[\s\x00]* (?: //[^\n]* (?![^\n]) [\s\x00]* )*'
+
+# The contents of a quoted string. A backslash escapes the character after it,
+# except that a backslash followed by a quote only escapes it if another quote
+# follows on the same line. Otherwise the backslash is literal and the quote
+# ends the string, as in "C:\maps\". At each backslash only one alternative
+# can match, so failed matches do not backtrack exponentially.
+_STRING = r'''
+    [^"\\]*
+    (?:
+        (?:   \\ [^"]
+            | \\ " (?= [^"\n]* " )
+            | \\ (?= " (?! [^"\n]* " ) )
+        )
+        [^"\\]*
+    )*
+'''
+
+# Matches one token per match, skipping anything in `_SKIP` before it. A key
+# and its value are matched together as one token. The last match is the end
+# of the string, and anything else that is not a brace is invalid.
+_TOKEN_RE = re.compile(r'''
+    {skip}
+    (?:
+          " (?P<key> {string} ) " {skip} " (?P<value> {string} ) "
+        | (?P<open> \{{ )
+        | (?P<close> \}} )
+        | " (?P<string> {string} ) "
+        | (?P<end> \Z )
+        | (?P<invalid> . )
+    )
+'''.format(skip=_SKIP, string=_STRING), re.VERBOSE | re.DOTALL)
+
+# Backslash escapes which are replaced within quoted strings. Other
+# backslashes, as in Windows paths, are left alone, as is a backslash at the
+# end of a string.
+_ESCAPE_RE = re.compile(r'\\(["\\])')
+
+def _vec(s):
+    return tuple(map(float, s.split()))
+
+def _vert(s):
+    # Fix up Quake 3's weird coordinate system.
+    x, y, z = _vec(s)
+    return (x, z, y)
+
+# Maps keys onto functions converting their values from strings to more
+# appropriate types. Values of other keys are left as strings.
+_KEY_TYPES = {
+    'origin': _vert,
+    'angle': float,
+    'radius': float,
+    'light': float,
+    'spawnflags': int,
+    '_color': _vec,
+}
+
+def _ents_gen(ents_str):
     """
-    Generate entities, each of which is a mapping of strings onto strings.
+    Generate entities, each of which is a mapping of keys onto values.
 
     """
-    it = iter(enumerate(ents_lines))
-
-    line = None
-    num = -1
-
-    def step():
-        nonlocal line, num
-        num, line = next(it)
-        while line is None or line == '' or line == '\x00':
-            num, line = next(it)
-            num += 1
-            line = line.strip()
-
-    def err(s):
-        raise BadEntsString("On line {} {}: {}".format(
-            num, line, s))
-
-    # Each iteration corresponds with an item.
-    step()
-    while True:
-        item = {}
-        if line != '{':
-            err("Expected opening brace")
-        step()
-        # Each iteration corresponds with a line.
-        while True:
-            if line == '}':
-                yield item
-                step()
-                break
-            else:
+    def err(pos, s):
+        line = ents_str.count('\n', 0, pos) + 1
+        raise BadEntsString("On line {}: {}".format(line, s))
+
+    ent = None
+    for m in _TOKEN_RE.finditer(ents_str):
+        kind = m.lastgroup
+        if kind == 'value':
+            if ent is None:
+                err(m.start('key'), "Expected opening brace")
+            key, value = m.group('key', 'value')
+            if '\\' in key:
+                key = _ESCAPE_RE.sub(r'\1', key)
+            if '\\' in value:
+                value = _ESCAPE_RE.sub(r'\1', value)
+            convert = _KEY_TYPES.get(key)
+            if convert is not None:
                 try:
-                    key, value = _parse_key_value(line)
-                    item[key] = value
-                    step()
-                except _InvalidKeyValue as e:
-                    err(str(e))
-
-def _fix_types_for_ent(ent):
-    """
-    Convert values of the given entity from strings to more appropriate types.
-
-    For example, make `origin` a tuple of floats.
-
-    """
-
-    def vec(s):
-        return tuple(float(x) for x in s.split(' '))
-
-    def vert(s):
-        # Fix up Quake 3's weird coordinate system.
-        out = vec(s)
-        return (out[0], out[2], out[1])
-
-    key_types = {
-        'origin': vert,
-        'angle': float,
-        'radius': float,
-        'light': float,
-        'spawnflags': int,
-        '_color': vec
-    }
-
-    return { key: key_types.get(key, lambda x: x)(value) 
-                for key, value in ent.items() }
+                    value = convert(value)
+                except ValueError as e:
+                    err(m.start(kind), "Bad value for {}: {}".format(key, e))
+            ent[key] = value
+        elif kind == 'open':
+            if ent is not None:
+                err(m.start(kind), "Unexpected opening brace")
+            ent = {}
+        elif kind == 'close':
+            if ent is None:
+                err(m.start(kind), "Unexpected closing brace")
+            yield ent
+            ent = None
+        elif kind == 'string':
+            err(m.start(kind), "Key {} has no value".format(m.group(kind)))
+        elif kind == 'invalid':
+            err(m.start(kind), "Expected a brace or a quoted string")
+
+    if ent is not None:
+        err(len(ents_str), "Expected closing brace")
 
 def parse(ents_str):
     """
-    Parse an ents string into an iterable of dicts.
+    Parse an ents string into a list of dicts.
 
-    """
-    ents_lines = ents_str.splitlines()
-    return [_fix_types_for_ent(ent) for ent in _ents_gen(ents_lines)]
+    `ents_str` may be a `str`, or the raw bytes of an entities lump. Values of
+    some keys are converted to more appropriate types. For example, `origin`
+    becomes a tuple of floats.
 
+    """
+    if not isinstance(ents_str, str):
+        ents_str = str(ents_str, 'latin-1')
+    return list(_ents_gen(ents_str))
@@ -1,52 +1,520 @@
-
+import collections
+import functools
 import io
+import mmap
 import os
 import os.path
+import sqlite3
+import struct
+import threading
 import zipfile
+import zlib
+
+from . import instrument
+
+
+# Layout of a zip local file header, up to and including the extra field
+# length. See section 4.3.7 of the PKWARE zip APPNOTE.
+_LOCAL_HEADER_FMT = "<4sHHHHHIIIHH"
+_LOCAL_HEADER_SIZE = struct.calcsize(_LOCAL_HEADER_FMT)
+_LOCAL_HEADER_MAGIC = b"PK\x03\x04"
+
+# Amount of compressed data fed to the decompressor at a time.
+_DECOMPRESS_CHUNK = 64 * 1024
+
+
+FileInfo = collections.namedtuple('FileInfo',
+    ['pk3_path', 'path', 'crc', 'size'])
+
+# Location of a file within a pk3, as read from the pk3's directory.
+_Entry = collections.namedtuple('_Entry',
+    ['pk3_path', 'header_offset', 'compress_size', 'file_size',
+     'compress_type', 'crc'])
+
+
+def default_cache_dir():
+    """
+    Return the directory in which persistent caches, such as the pk3 index
+    and the texture color cache, are kept by default.
+
+    """
+    cache_dir = os.environ.get("XDG_CACHE_HOME",
+                               os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_dir, "q3bsp2povray")
+
+
+def default_index_path():
+    """Return the default location of the persistent pk3 index."""
+    return os.path.join(default_cache_dir(), "pk3index.sqlite")
+
+
+def _pak_sort_key(pk3_path):
+    # Quake 3 orders the pk3s in a directory by case-insensitive name, with
+    # files in later pk3s overriding those in earlier ones.
+    return (os.path.dirname(pk3_path), os.path.basename(pk3_path).lower())
+
+
+def _read_pk3_dir(pk3_path):
+    """Return a dict mapping names onto `_Entry`s for each file in a pk3."""
+    with zipfile.ZipFile(pk3_path) as zip_file:
+        return {
+            info.filename: _Entry(pk3_path=pk3_path,
+                                  header_offset=info.header_offset,
+                                  compress_size=info.compress_size,
+                                  file_size=info.file_size,
+                                  compress_type=info.compress_type,
+                                  crc=info.CRC)
+                for info in zip_file.infolist()
+        }
+
+
+class _Pk3Index():
+    """
+    A persistent index of the directories of pk3 files, stored in an SQLite
+    database.
+
+    A pk3's entries are re-read whenever its modification time or size differ
+    from when it was indexed.
+
+    """
+
+    _VERSION = 1
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._db = sqlite3.connect(path)
+        if (self._db.execute("PRAGMA user_version").fetchone()[0] !=
+                self._VERSION):
+            self._db.execute("DROP TABLE IF EXISTS pk3s")
+            self._db.execute("DROP TABLE IF EXISTS entries")
+            self._db.execute("PRAGMA user_version = {}".format(
+                self._VERSION))
+        self._db.execute("CREATE TABLE IF NOT EXISTS pk3s ("
+                         "pk3_path TEXT PRIMARY KEY, mtime_ns INTEGER, "
+                         "size INTEGER)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                         "pk3_path TEXT, path TEXT, header_offset INTEGER, "
+                         "compress_size INTEGER, file_size INTEGER, "
+                         "compress_type INTEGER, crc INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_pk3_path "
+                         "ON entries (pk3_path)")
+
+    def entries(self, pk3_path):
+        """
+        Return a dict mapping names onto `_Entry`s for each file in a pk3.
+
+        """
+        stat = os.stat(pk3_path)
+        row = self._db.execute("SELECT mtime_ns, size FROM pk3s "
+                               "WHERE pk3_path = ?", (pk3_path,)).fetchone()
+        if row == (stat.st_mtime_ns, stat.st_size):
+            return {
+                row[0]: _Entry._make((pk3_path,) + row[1:])
+                    for row in self._db.execute(
+                        "SELECT path, header_offset, compress_size, "
+                        "file_size, compress_type, crc FROM entries "
+                        "WHERE pk3_path = ?", (pk3_path,))
+            }
+
+        entries = _read_pk3_dir(pk3_path)
+        with self._db:
+            self._db.execute("DELETE FROM entries WHERE pk3_path = ?",
+                             (pk3_path,))
+            self._db.executemany(
+                "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((pk3_path, name) + tuple(entry[1:])
+                    for name, entry in entries.items()))
+            self._db.execute("INSERT OR REPLACE INTO pk3s VALUES (?, ?, ?)",
+                             (pk3_path, stat.st_mtime_ns, stat.st_size))
+        return entries
+
+    def close(self):
+        self._db.close()
+
+
+def _seek_pos(pos, size, offset, whence):
+    if whence == io.SEEK_SET:
+        new_pos = offset
+    elif whence == io.SEEK_CUR:
+        new_pos = pos + offset
+    elif whence == io.SEEK_END:
+        new_pos = size + offset
+    else:
+        raise ValueError("Invalid whence {}".format(whence))
+    if new_pos < 0:
+        raise ValueError("Negative seek position {}".format(new_pos))
+    return new_pos
+
+
+class _StoredMemberFile(io.RawIOBase):
+    """
+    Seekable file-like object for a member stored uncompressed in a pk3.
+
+    Reads copy directly from a memory map of the pk3.
+
+    """
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._data[self._pos:self._pos + len(b)]
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def readall(self):
+        data = self._data[self._pos:].tobytes()
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._pos = _seek_pos(self._pos, len(self._data), offset, whence)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+class _DeflatedMemberFile(io.RawIOBase):
+    """
+    Seekable file-like object for a deflated member of a pk3.
+
+    Reads decompress forwards from the current position, taking compressed
+    data from a memory map of the pk3. Seeking backwards restarts
+    decompression from the start of the member.
+
+    If `on_complete` is not `None` and the whole member is read in order from
+    the start, it is called with the member's decompressed contents, after
+    checking the CRC.
+
+    """
+    def __init__(self, data, size, crc, on_complete):
+        self._data = data
+        self._size = size
+        self._crc = crc
+        self._pos = 0
+        self._on_complete = on_complete
+        self._chunks = [] if on_complete is not None else None
+        self._captured = 0
+        self._restart()
+
+    def _restart(self):
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._in_pos = 0
+        self._out_pos = 0
+
+    def _decompress(self, n):
+        """Decompress up to `n` bytes from `_out_pos`."""
+        out = []
+        while n > 0 and self._out_pos < self._size:
+            data = self._decompressor.unconsumed_tail
+            if not data:
+                data = self._data[self._in_pos:
+                                  self._in_pos + _DECOMPRESS_CHUNK]
+                self._in_pos += len(data)
+            chunk = self._decompressor.decompress(data, n)
+            if not chunk and not data:
+                raise zipfile.BadZipFile("Truncated deflated member")
+            out.append(chunk)
+            n -= len(chunk)
+            self._out_pos += len(chunk)
+        return b"".join(out)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _capture(self, data):
+        if self._chunks is None or self._pos != self._captured:
+            return
+        self._chunks.append(data)
+        self._captured += len(data)
+        if self._captured == self._size:
+            data = b"".join(self._chunks)
+            self._chunks = None
+            if zlib.crc32(data) != self._crc:
+                raise zipfile.BadZipFile("Bad CRC for deflated member")
+            self._on_complete(data)
+
+    def _read(self, n):
+        if self._pos < self._out_pos:
+            self._restart()
+        while self._out_pos < self._pos:
+            if not self._decompress(min(self._pos - self._out_pos,
+                                        _DECOMPRESS_CHUNK)):
+                break
+        data = self._decompress(n)
+        self._capture(data)
+        self._pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self._read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def readall(self):
+        return self._read(max(0, self._size - self._pos))
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._pos = _seek_pos(self._pos, self._size, offset, whence)
+        return self._pos
+
+    def tell(self):
+        return self._pos
 
 
 class FileSystem():
-    def __init__(self, pk3_paths):
-        """Initialize a Q3 Filesystem given a list of PK3 files."""
-        pk3_paths = sorted(pk3_paths)
+    def __init__(self, pk3_paths, cache_bytes=64 * 1024 * 1024,
+                 index_path=None):
+        """
+        Initialize a Q3 Filesystem given a list of PK3 files.
+
+        Decompressed files are kept in a least recently used cache, holding at
+        most `cache_bytes` bytes. The `cache_hits` and `cache_misses`
+        attributes count lookups in the cache.
 
-        self._zip_files = [zipfile.ZipFile(pk3_path) for
-                           pk3_path in pk3_paths]
+        If `index_path` is given, the directories of the pk3s are read from
+        (and stored in) a persistent index at that path, so unchanged pk3s are
+        not opened until one of their files is read. If the index cannot be
+        opened or written, the pk3 directories are read as if no index had
+        been given, and `index_path` is set to `None`.
 
-        # _dir_dict maps paths onto zip files.
+        Files may be opened and read from several threads at once. All reads
+        go through a single read-only memory map of each pk3, so no file
+        handles are held open, or shared between threads.
+
+        """
+        pk3_paths = sorted((os.path.abspath(pk3_path)
+                                for pk3_path in pk3_paths),
+                           key=_pak_sort_key)
+        self.pk3_paths = pk3_paths
+        self.index_path = index_path
+
+        # _lock protects `_cache`, its counters and `_mmaps`.
+        self._lock = threading.Lock()
+
+        # _cache maps paths onto decompressed contents, least recently used
+        # first.
+        self._cache = collections.OrderedDict()
+        self._cache_size = 0
+        self.cache_bytes = cache_bytes
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # _mmaps maps pk3 paths onto read-only maps of the whole pk3, created
+        # when a file in the pk3 is first read.
+        self._mmaps = {}
+
+        # _dir_dict maps paths onto `_Entry`s. Files in later pk3s take
+        # precedence.
         self._dir_dict = {}
-        for zip_file in self._zip_files:
-            self._dir_dict.update(
-                { name: zip_file for name in zip_file.namelist() })
+        with instrument.stage("pk3-index"):
+            if index_path is not None:
+                try:
+                    self._dir_dict = self._read_index(index_path)
+                except (OSError, sqlite3.Error):
+                    # The index only saves time, so if it cannot be opened or
+                    # updated (eg. the cache directory is read-only) read the
+                    # pk3 directories instead.
+                    self.index_path = index_path = None
+            if index_path is None:
+                for pk3_path in pk3_paths:
+                    self._dir_dict.update(_read_pk3_dir(pk3_path))
+
+            # _folded_dict maps lower-cased paths onto paths. Like
+            # `_dir_dict`, paths in later pk3s take precedence.
+            self._folded_dict = { name.lower(): name
+                                      for name in self._dir_dict }
+        instrument.count("pk3-files", len(self._dir_dict))
+
+        self._sorted_paths = None
+
+    def _read_index(self, index_path):
+        dir_dict = {}
+        index = _Pk3Index(index_path)
+        try:
+            for pk3_path in self.pk3_paths:
+                dir_dict.update(index.entries(pk3_path))
+        finally:
+            index.close()
+        return dir_dict
 
     @classmethod
-    def from_dir(cls, path):
-        """Initialise a Q3 Filesystem given a base directory."""
+    def from_dir(cls, path, **kwargs):
+        """
+        Initialise a Q3 Filesystem given a base directory.
+
+        Keyword arguments are passed to the constructor.
+
+        """
         pk3_paths = (full for full in
                         (os.path.join(path, base)
                             for base in os.listdir(path))
                         if full.endswith(".pk3") and
                             os.path.isfile(full))
-        return cls(pk3_paths)
+        return cls(pk3_paths, **kwargs)
 
     @property
     def paths(self):
         """Return an iterable of paths in the filesystem."""
 
-        return sorted(self._dir_dict.keys())
+        if self._sorted_paths is None:
+            self._sorted_paths = sorted(self._dir_dict.keys())
+        return self._sorted_paths
 
-    def open(self, path):
-        """Open a file as a file-like object."""
+    def find(self, stem, extensions=(".tga", ".jpg")):
+        """
+        Find a file by case-insensitive name, trying each of a sequence of
+        extensions.
+
+        The default extensions are in the order that Quake 3 tries them when
+        loading a texture.
+
+        Returns:
+            The path of the first match, suitable for passing to `open`.
 
+        Raises:
+            KeyError: If no file matches.
+
+        """
+        folded_stem = stem.lower()
+        for ext in extensions:
+            try:
+                return self._folded_dict[folded_stem + ext.lower()]
+            except KeyError:
+                pass
+        raise KeyError("There is no item named {} with any extension in {} "
+                       "in the filesystem".format(stem, extensions))
+
+    def _lookup(self, path):
         try:
-            zip_file = self._dir_dict[path]
+            return self._dir_dict[path]
         except KeyError:
             raise KeyError("There is no item named {} in the "
                            "filesystem".format(path))
 
-        # The default ZipFile doesn't support seeking, so wrap it.
-        with zip_file.open(path) as f:
-            out_f = io.BytesIO(f.read())
+    def info(self, path):
+        """
+        Return a `FileInfo` describing where a file comes from.
+
+        The CRC and (uncompressed) size are read from the pk3's directory, so
+        the file itself is not read.
+
+        """
+        entry = self._lookup(path)
+        return FileInfo(pk3_path=entry.pk3_path,
+                        path=path,
+                        crc=entry.crc,
+                        size=entry.file_size)
+
+    def _pk3_mmap(self, pk3_path):
+        with self._lock:
+            if pk3_path not in self._mmaps:
+                with open(pk3_path, "rb") as f:
+                    self._mmaps[pk3_path] = mmap.mmap(
+                        f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._mmaps[pk3_path]
+
+    def _cache_get(self, path):
+        with self._lock:
+            try:
+                data = self._cache[path]
+            except KeyError:
+                self.cache_misses += 1
+                return None
+            self._cache.move_to_end(path)
+            self.cache_hits += 1
+            return data
+
+    def _cache_put(self, path, data):
+        with self._lock:
+            if len(data) > self.cache_bytes or path in self._cache:
+                return
+            self._cache[path] = data
+            self._cache_size += len(data)
+            while self._cache_size > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_size -= len(evicted)
+
+    def _entry_data(self, path, entry):
+        """
+        Return a memoryview of a file's data, as stored (possibly compressed)
+        in its pk3.
+
+        """
+        if entry.compress_type not in (zipfile.ZIP_STORED,
+                                       zipfile.ZIP_DEFLATED):
+            # Quake 3 itself only supports these methods.
+            raise zipfile.BadZipFile(
+                "Unsupported compression method {} for {}".format(
+                    entry.compress_type, path))
+
+        pk3_map = self._pk3_mmap(entry.pk3_path)
+        header = struct.unpack_from(_LOCAL_HEADER_FMT, pk3_map,
+                                    entry.header_offset)
+        if header[0] != _LOCAL_HEADER_MAGIC:
+            raise zipfile.BadZipFile("Bad local header for {}".format(path))
+        name_len, extra_len = header[-2:]
+        start = (entry.header_offset + _LOCAL_HEADER_SIZE +
+                 name_len + extra_len)
+
+        return memoryview(pk3_map)[start:start + entry.compress_size]
+
+    def map(self, path):
+        """
+        Return the contents of a file as a read-only buffer.
+
+        Files stored uncompressed are returned as a memoryview onto a memory
+        map of the containing pk3, so no data is copied. Compressed files are
+        decompressed into a single `bytes` object, which is cached.
+
+        """
+        entry = self._lookup(path)
+        if entry.compress_type == zipfile.ZIP_STORED:
+            return self._entry_data(path, entry)
+
+        data = self._cache_get(path)
+        if data is None:
+            data = zlib.decompress(self._entry_data(path, entry),
+                                   -zlib.MAX_WBITS)
+            if zlib.crc32(data) != entry.crc:
+                raise zipfile.BadZipFile("Bad CRC for {}".format(path))
+            self._cache_put(path, data)
+        return data
+
+    def open(self, path):
+        """
+        Open a file as a seekable, read-only file-like object.
+
+        Data is read from the pk3 as it is requested. Files stored
+        uncompressed are read directly from a memory map of the pk3.
+        Compressed files are decompressed as they are read, unless they are in
+        the cache. Compressed files that are read in full are added to the
+        cache.
+
+        """
+        entry = self._lookup(path)
+        if entry.compress_type == zipfile.ZIP_STORED:
+            return _StoredMemberFile(self._entry_data(path, entry))
 
-        return out_f
+        data = self._cache_get(path)
+        if data is not None:
+            return io.BytesIO(data)
 
+        on_complete = None
+        if entry.file_size <= self.cache_bytes:
+            on_complete = functools.partial(self._cache_put, path)
+        return _DeflatedMemberFile(self._entry_data(path, entry),
+                                   entry.file_size, entry.crc, on_complete)
@@ -0,0 +1,273 @@
+"""
+Record the time and memory taken by each stage of a conversion, along with
+counts of the things processed.
+
+Library code marks stages with `stage` or `staged`, and counts things with
+`count`. These do nothing unless a `Profiler` is active, as it is within a
+`profiling` block::
+
+    with q3.instrument.profiling() as profiler:
+        ...
+    json.dump(profiler.as_dict(), f)
+
+Stages may be nested, in which case the time and memory of the inner stage
+is also included in the outer stage. A stage entered several times
+accumulates time, and records the highest peak memory of any entry.
+
+"""
+
+__all__ = (
+    'active',
+    'count',
+    'CountingWriter',
+    'profiling',
+    'profiling_to_file',
+    'reset',
+    'Profiler',
+    'stage',
+    'staged',
+)
+
+
+import collections
+import contextlib
+import functools
+import json
+import sys
+import time
+import tracemalloc
+
+
+class _StageStats():
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.
+        self.cpu = 0.
+        self.peak_memory = None
+
+    def as_dict(self):
+        return collections.OrderedDict([
+            ("calls", self.calls),
+            ("wall", self.wall),
+            ("cpu", self.cpu),
+            ("peak_memory", self.peak_memory),
+        ])
+
+
+class Profiler():
+    """
+    Per-stage timings and peak memory usage, and counters.
+
+    """
+
+    def __init__(self, trace_memory=True):
+        """
+        Create a profiler.
+
+        If `trace_memory` is true, `tracemalloc` is used to record the peak
+        memory allocated within each stage. This slows down the profiled code
+        considerably.
+
+        """
+        self.trace_memory = trace_memory
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+        # _peaks holds the peak memory seen so far in each stage that has
+        # been entered but not exited, innermost last.
+        self._peaks = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that records a stage."""
+        if self.trace_memory:
+            # Resetting the peak would lose the enclosing stage's peak so far,
+            # so remember it.
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1],
+                                      tracemalloc.get_traced_memory()[1])
+            start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            self._peaks.append(0)
+
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            stats = self.stages.setdefault(name, _StageStats())
+            stats.calls += 1
+            stats.wall += time.perf_counter() - start_wall
+            stats.cpu += time.process_time() - start_cpu
+
+            if self.trace_memory:
+                peak = max(self._peaks.pop(),
+                           tracemalloc.get_traced_memory()[1])
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+                # Record the peak relative to the memory in use when the
+                # stage was entered.
+                peak -= start_memory
+                if stats.peak_memory is None or peak > stats.peak_memory:
+                    stats.peak_memory = peak
+
+    def count(self, name, n=1):
+        """Add `n` to a counter."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self):
+        """
+        Return the stages and counters as a dict, suitable for serializing as
+        JSON.
+
+        Times are in seconds, and memory is in bytes. `peak_memory` is `None`
+        if memory was not traced.
+
+        """
+        return collections.OrderedDict([
+            ("stages", collections.OrderedDict(
+                (name, stats.as_dict())
+                    for name, stats in self.stages.items())),
+            ("counters", collections.OrderedDict(self.counters)),
+        ])
+
+    def merge(self, profile):
+        """
+        Add in the stages and counters from a dict returned by `as_dict`,
+        such as one recorded in another process.
+
+        """
+        for name, stage_dict in profile["stages"].items():
+            stats = self.stages.setdefault(name, _StageStats())
+            stats.calls += stage_dict["calls"]
+            stats.wall += stage_dict["wall"]
+            stats.cpu += stage_dict["cpu"]
+            if stage_dict["peak_memory"] is not None:
+                stats.peak_memory = max(stats.peak_memory or 0,
+                                        stage_dict["peak_memory"])
+        for name, n in profile["counters"].items():
+            self.count(name, n)
+
+    def dump(self, f):
+        """Write the stages and counters to a file as JSON."""
+        json.dump(self.as_dict(), f, indent=4)
+        f.write("\n")
+
+
+# The active profiler, if any.
+_profiler = None
+
+
+@contextlib.contextmanager
+def profiling(trace_memory=True):
+    """
+    Context manager that makes a new `Profiler` active, and yields it.
+
+    """
+    global _profiler
+    assert _profiler is None, "Already profiling"
+
+    profiler = Profiler(trace_memory)
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    _profiler = profiler
+    try:
+        yield profiler
+    finally:
+        _profiler = None
+        if started_tracing:
+            tracemalloc.stop()
+
+
+def reset():
+    """
+    Discard the active profiler, if any, and stop tracing memory.
+
+    This is for worker processes, which may have inherited an active profiler
+    from the process that forked them.
+
+    """
+    global _profiler
+    _profiler = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def active():
+    """Return the active `Profiler`, or `None` if there is none."""
+    return _profiler
+
+
+@contextlib.contextmanager
+def profiling_to_file(path, trace_memory=True):
+    """
+    Context manager that profiles its block if `path` is not `None`, and
+    then writes the results to `path` as JSON.
+
+    A `path` of "-" writes the results to stderr.
+
+    """
+    if path is None:
+        yield None
+        return
+
+    with profiling(trace_memory) as profiler:
+        yield profiler
+    if path == "-":
+        profiler.dump(sys.stderr)
+    else:
+        with open(path, "w") as f:
+            profiler.dump(f)
+
+
+def stage(name):
+    """
+    Context manager that records a stage with the active profiler, if any.
+
+    """
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.stage(name)
+
+
+def staged(name):
+    """
+    Decorator that records each call of a function as a stage with the
+    active profiler, if any.
+
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return fn(*args, **kwargs)
+            with _profiler.stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    """Add `n` to a counter of the active profiler, if any."""
+    if _profiler is not None:
+        _profiler.count(name, n)
+
+
+class CountingWriter():
+    """
+    Wrap a file, counting the characters (or bytes, for a binary file) written
+    to it in a counter.
+
+    """
+
+    def __init__(self, f, counter):
+        self._f = f
+        self._counter = counter
+
+    def write(self, s):
+        count(self._counter, len(s))
+        return self._f.write(s)
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
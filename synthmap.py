@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+
+"""
+Generate synthetic Quake 3 maps, and pk3 files containing them.
+
+Maps are made of randomly placed polygon, patch and mesh faces, with a BSP
+tree, visibility information and entities (including a camera and lights), so
+that they can be converted without a Quake 3 installation. A map's textures
+are gradients with some noise added, to roughly approximate the detail in
+real textures, and are alternately JPEG and TGA files.
+
+Note this module requires pillow (or equivalent) to be installed.
+
+"""
+
+
+__all__ = (
+    'main',
+    'make_bsp',
+    'make_texture',
+    'SynthParams',
+    'write_pk3s',
+)
+
+
+import argparse
+import collections
+import io
+import math
+import os
+import random
+import struct
+import sys
+import zipfile
+
+from PIL import Image
+
+
+# Parameters of a synthetic map: the numbers of polygon, patch and mesh faces,
+# of textures and of entities, and the seed of the random number generator
+# that places them.
+SynthParams = collections.namedtuple('SynthParams',
+    ['polygons', 'patches', 'meshes', 'textures', 'entities', 'seed'],
+    defaults=(1000, 50, 50, 16, 500, 0))
+
+_BSP_MAGIC = b"IBSP"
+_BSP_VERSION = 0x2e
+_NUM_LUMPS = 17
+
+# Lump numbers, as in `q3.bsp._LumpEnum`.
+_ENTITIES = 0
+_TEXTURES = 1
+_PLANES = 2
+_NODES = 3
+_LEAFS = 4
+_LEAFFACES = 5
+_MODELS = 7
+_VERTEXES = 10
+_MESHVERTS = 11
+_FACES = 13
+_VISDATA = 16
+
+# Face types, as in `q3.bsp._FaceType`.
+_POLYGON = 1
+_PATCH = 2
+_MESH = 3
+
+# Leaves of the BSP tree hold at most this many faces.
+_MAX_LEAF_FACES = 32
+
+_VERTEX_STRUCT = struct.Struct("<3f2f2f3f4B")
+_FACE_STRUCT = struct.Struct("<12i12f2i")
+
+
+class _MapBuilder():
+    """
+    Accumulates the vertices, mesh vertices and faces of a map.
+
+    Coordinates are in Quake 3's coordinate system, with Z up.
+
+    """
+
+    def __init__(self, rng, params):
+        self._rng = rng
+        self._params = params
+        self.vertexes = []
+        self.meshverts = []
+        self.faces = []
+        # centers holds the center of each face, for building the BSP tree.
+        self.centers = []
+
+        num_faces = params.polygons + params.patches + params.meshes
+        self.extent = 128. * math.sqrt(max(1, num_faces))
+
+    def _random_point(self):
+        e = self.extent
+        return (self._rng.uniform(-e, e), self._rng.uniform(-e, e),
+                self._rng.uniform(0., 256.))
+
+    def _random_frame(self):
+        """
+        Return an axis-aligned orthonormal frame `(u, v, normal)` for a face.
+
+        """
+        axes = [(1., 0., 0.), (0., 1., 0.), (0., 0., 1.)]
+        normal_axis = self._rng.randrange(3)
+        normal = axes.pop(normal_axis)
+        return axes[0], axes[1], normal
+
+    def _add_vertex(self, position, normal):
+        self.vertexes.append(
+            _VERTEX_STRUCT.pack(*position,
+                                position[0] / 64., position[1] / 64.,
+                                0., 0.,
+                                *normal,
+                                255, 255, 255, 255))
+
+    def _add_face(self, face_type, texture, first_vertex, n_vertexes,
+                  normal, meshvert=0, n_meshverts=0, size=(0, 0)):
+        self.faces.append(_FACE_STRUCT.pack(
+            texture, -1, face_type, first_vertex, n_vertexes,
+            meshvert, n_meshverts,
+            -1, 0, 0, 0, 0,
+            *(0.,) * 9, *normal,
+            *size))
+
+    def _texture(self):
+        return self._rng.randrange(self._params.textures)
+
+    def add_polygon(self):
+        """Add a regular polygon face, with 3 to 8 sides."""
+        center = self._random_point()
+        u, v, normal = self._random_frame()
+        sides = self._rng.randint(3, 8)
+        radius = self._rng.uniform(16., 128.)
+        angle = self._rng.uniform(0., 2. * math.pi)
+
+        first_vertex = len(self.vertexes)
+        for i in range(sides):
+            a = angle + 2. * math.pi * i / sides
+            du, dv = radius * math.cos(a), radius * math.sin(a)
+            self._add_vertex(tuple(c + du * x + dv * y
+                                       for c, x, y in zip(center, u, v)),
+                             normal)
+
+        meshvert = len(self.meshverts)
+        for i in range(1, sides - 1):
+            self.meshverts.extend((0, i, i + 1))
+        self._add_face(_POLYGON, self._texture(), first_vertex, sides, normal,
+                       meshvert, len(self.meshverts) - meshvert)
+        self.centers.append(center)
+
+    def add_patch(self):
+        """Add a patch face, curved like a wave along one axis."""
+        center = self._random_point()
+        u, v, normal = self._random_frame()
+        width = self._rng.choice((3, 5, 7))
+        height = self._rng.choice((3, 5))
+        spacing = self._rng.uniform(16., 64.)
+        amplitude = self._rng.uniform(8., 64.)
+
+        first_vertex = len(self.vertexes)
+        for j in range(height):
+            for i in range(width):
+                du = spacing * (i - width // 2)
+                dv = spacing * (j - height // 2)
+                dn = amplitude * (i % 2)
+                self._add_vertex(tuple(c + du * x + dv * y + dn * n
+                                           for c, x, y, n
+                                           in zip(center, u, v, normal)),
+                                 normal)
+
+        self._add_face(_PATCH, self._texture(), first_vertex, width * height,
+                       normal, size=(width, height))
+        self.centers.append(center)
+
+    def add_mesh(self):
+        """Add a mesh face: a small grid of triangles with random heights."""
+        center = self._random_point()
+        u, v, normal = self._random_frame()
+        size = 4
+        spacing = self._rng.uniform(8., 32.)
+
+        first_vertex = len(self.vertexes)
+        for j in range(size):
+            for i in range(size):
+                du = spacing * (i - size / 2)
+                dv = spacing * (j - size / 2)
+                dn = self._rng.uniform(0., spacing)
+                self._add_vertex(tuple(c + du * x + dv * y + dn * n
+                                           for c, x, y, n
+                                           in zip(center, u, v, normal)),
+                                 normal)
+
+        meshvert = len(self.meshverts)
+        for j in range(size - 1):
+            for i in range(size - 1):
+                k = i + j * size
+                self.meshverts.extend((k, k + 1, k + size + 1,
+                                       k, k + size + 1, k + size))
+        self._add_face(_MESH, self._texture(), first_vertex, size * size,
+                       normal, meshvert, len(self.meshverts) - meshvert)
+        self.centers.append(center)
+
+
+class _TreeBuilder():
+    """
+    Builds a BSP tree over a map's faces, splitting at the median face center
+    along alternating horizontal axes.
+
+    Each leaf is its own cluster, and the visibility information says that
+    clusters can see each other if they are close together.
+
+    """
+
+    def __init__(self, centers, extent):
+        self._centers = centers
+        self._extent = extent
+        self.planes = []
+        self.nodes = []
+        self.leafs = []
+        self.leaffaces = []
+        # leaf_bounds holds the `(mins, maxs)` of each leaf.
+        self._leaf_bounds = []
+
+        self._build(list(range(len(centers))), 0,
+                    [-extent, -extent, -1024.], [extent, extent, 1024.])
+
+    def _build(self, face_indices, depth, mins, maxs):
+        """Build a subtree, returning its child index in the parent node."""
+        # The root is always a node, even in tiny maps.
+        if depth > 0 and (len(face_indices) <= _MAX_LEAF_FACES or
+                          depth >= 32):
+            leaf = len(self.leafs)
+            self.leafs.append((leaf, 0) +
+                              tuple(map(int, mins)) + tuple(map(int, maxs)) +
+                              (len(self.leaffaces), len(face_indices), 0, 0))
+            self.leaffaces.extend(face_indices)
+            self._leaf_bounds.append((mins, maxs))
+            return -(leaf + 1)
+
+        axis = depth % 2
+        face_indices.sort(key=lambda f: self._centers[f][axis])
+        mid = len(face_indices) // 2
+        dist = (self._centers[face_indices[mid]][axis] if face_indices else
+                0.)
+
+        plane = len(self.planes)
+        normal = [0., 0., 0.]
+        normal[axis] = 1.
+        self.planes.append((*normal, dist))
+
+        node = len(self.nodes)
+        self.nodes.append(None)
+        front_mins = list(mins)
+        front_mins[axis] = dist
+        back_maxs = list(maxs)
+        back_maxs[axis] = dist
+        front = self._build(face_indices[mid:], depth + 1, front_mins, maxs)
+        back = self._build(face_indices[:mid], depth + 1, mins, back_maxs)
+        self.nodes[node] = ((plane, front, back) +
+                            tuple(map(int, mins)) + tuple(map(int, maxs)))
+        return node
+
+    def visdata(self):
+        num_clusters = len(self.leafs)
+        sz_vecs = (num_clusters + 7) // 8
+        centers = [tuple((a + b) / 2. for a, b in zip(*bounds))
+                       for bounds in self._leaf_bounds]
+        vis_dist = self._extent / 2.
+
+        vecs = bytearray(num_clusters * sz_vecs)
+        for i, a in enumerate(centers):
+            for j, b in enumerate(centers):
+                if math.dist(a[:2], b[:2]) <= vis_dist:
+                    vecs[i * sz_vecs + j // 8] |= 1 << (j % 8)
+
+        return struct.pack("<ii", num_clusters, sz_vecs) + bytes(vecs)
+
+
+def _entities_lump(rng, params, extent):
+    ents = [
+        '{\n"classname" "worldspawn"\n"message" "Synthetic map"\n}',
+        '{\n"classname" "info_player_intermission"\n'
+            '"origin" "0 0 192"\n"target" "camera_target"\n}',
+        '{{\n"classname" "target_position"\n"targetname" "camera_target"\n'
+            '"origin" "{} {} 64"\n}}'.format(int(extent), int(extent)),
+    ]
+    for i in range(max(0, params.entities - len(ents))):
+        origin = "{:.0f} {:.0f} {:.0f}".format(rng.uniform(-extent, extent),
+                                               rng.uniform(-extent, extent),
+                                               rng.uniform(32., 256.))
+        if i % 4 == 3:
+            # Some entities are written on one line, as some tools do.
+            ents.append('{{ "classname" "info_player_deathmatch" '
+                        '"origin" "{}" "angle" "{}" }}'.format(
+                            origin, rng.randrange(360)))
+        else:
+            ents.append('{{\n"classname" "light"\n"origin" "{}"\n'
+                        '"light" "{}"\n"_color" "{:.2f} {:.2f} {:.2f}"\n}}'
+                        .format(origin, rng.randrange(100, 500),
+                                rng.random(), rng.random(), rng.random()))
+
+    return ("\n".join(ents) + "\n").encode("ascii") + b"\x00"
+
+
+def _texture_names(params):
+    return ["textures/synth/tex{}".format(i) for i in range(params.textures)]
+
+
+def make_bsp(params=SynthParams()):
+    """
+    Return the contents of a synthetic BSP file, as `bytes`.
+
+    `params` is a `SynthParams`. The faces' textures are named as returned
+    by `write_pk3s`.
+
+    """
+    rng = random.Random(params.seed)
+
+    builder = _MapBuilder(rng, params)
+    # Interleave the face types so that each is spread over the map.
+    kinds = ([builder.add_polygon] * params.polygons +
+             [builder.add_patch] * params.patches +
+             [builder.add_mesh] * params.meshes)
+    rng.shuffle(kinds)
+    for add_face in kinds:
+        add_face()
+
+    tree = _TreeBuilder(builder.centers, builder.extent)
+
+    lumps = [b""] * _NUM_LUMPS
+    lumps[_ENTITIES] = _entities_lump(rng, params, builder.extent)
+    lumps[_TEXTURES] = b"".join(struct.pack("<64sii", name.encode("ascii"),
+                                            0, 1)
+                                    for name in _texture_names(params))
+    lumps[_PLANES] = b"".join(struct.pack("<4f", *plane)
+                                  for plane in tree.planes)
+    lumps[_NODES] = b"".join(struct.pack("<9i", *node)
+                                 for node in tree.nodes)
+    lumps[_LEAFS] = b"".join(struct.pack("<12i", *leaf)
+                                 for leaf in tree.leafs)
+    lumps[_LEAFFACES] = struct.pack("<{}i".format(len(tree.leaffaces)),
+                                    *tree.leaffaces)
+    e = builder.extent
+    lumps[_MODELS] = struct.pack("<6f4i", -e, -e, -1024., e, e, 1024.,
+                                 0, len(builder.faces), 0, 0)
+    lumps[_VERTEXES] = b"".join(builder.vertexes)
+    lumps[_MESHVERTS] = struct.pack("<{}i".format(len(builder.meshverts)),
+                                    *builder.meshverts)
+    lumps[_FACES] = b"".join(builder.faces)
+    lumps[_VISDATA] = tree.visdata()
+
+    out = io.BytesIO()
+    out.write(_BSP_MAGIC)
+    out.write(struct.pack("<i", _BSP_VERSION))
+    offset = 8 + 8 * _NUM_LUMPS
+    for lump in lumps:
+        out.write(struct.pack("<ii", offset, len(lump)))
+        offset += len(lump)
+    for lump in lumps:
+        out.write(lump)
+
+    return out.getvalue()
+
+
+def make_texture(idx, size=256, fmt="JPEG"):
+    """
+    Return the contents of a synthetic texture image file, as `bytes`.
+
+    Each `idx` gives a different image. `fmt` is a format name understood by
+    pillow, such as "JPEG" or "TGA".
+
+    """
+    gradient = Image.linear_gradient("L").resize((size, size)).rotate(30 * idx)
+    noise = Image.effect_noise((size, size), 8)
+    im = Image.merge("RGB", [Image.blend(gradient, noise, 0.1 * (c + 1))
+                                 for c in range(3)])
+    out = io.BytesIO()
+    im.save(out, fmt)
+    return out.getvalue()
+
+
+def write_pk3s(out_dir, params=SynthParams(), map_names=("synth",),
+               tex_size=256):
+    """
+    Write pk3 files containing synthetic maps and their textures.
+
+    `pak0.pk3` holds the textures, alternately as JPEG and TGA files and
+    alternately stored and compressed. `pak1.pk3` holds a map for each of
+    `map_names`, compressed, and `pak2.pk3` holds the same maps uncompressed.
+    The maps in `pak2.pk3` are named with a `_stored` suffix. Each map is
+    generated with a different seed.
+
+    Returns:
+        A list of the names of the textures.
+
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    tex_names = _texture_names(params)
+
+    with zipfile.ZipFile(os.path.join(out_dir, "pak0.pk3"), "w") as pk3:
+        for idx, tex_name in enumerate(tex_names):
+            ext, fmt = (".jpg", "JPEG") if idx % 2 == 0 else (".tga", "TGA")
+            compress_type = (zipfile.ZIP_STORED if idx % 4 < 2 else
+                             zipfile.ZIP_DEFLATED)
+            pk3.writestr(tex_name + ext, make_texture(idx, tex_size, fmt),
+                         compress_type=compress_type)
+
+    bsps = [make_bsp(params._replace(seed=params.seed + idx))
+                for idx in range(len(map_names))]
+    for pk3_name, compress_type, suffix in (
+            ("pak1.pk3", zipfile.ZIP_DEFLATED, ""),
+            ("pak2.pk3", zipfile.ZIP_STORED, "_stored")):
+        with zipfile.ZipFile(os.path.join(out_dir, pk3_name), "w") as pk3:
+            for map_name, bsp in zip(map_names, bsps):
+                pk3.writestr("maps/{}{}.bsp".format(map_name, suffix), bsp,
+                             compress_type=compress_type)
+
+    return tex_names
+
+
+def _parse_args(in_args):
+    defaults = SynthParams()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", "-d", required=True,
+                        help="Directory to write pk3 files to")
+    parser.add_argument("--maps", "-m", nargs="+", default=["synth"],
+                        help="Names of the maps to generate (default: synth)")
+    parser.add_argument("--polygons", type=int, default=defaults.polygons,
+                        help="Number of polygon faces per map")
+    parser.add_argument("--patches", type=int, default=defaults.patches,
+                        help="Number of patch faces per map")
+    parser.add_argument("--meshes", type=int, default=defaults.meshes,
+                        help="Number of mesh faces per map")
+    parser.add_argument("--textures", type=int, default=defaults.textures,
+                        help="Number of textures")
+    parser.add_argument("--entities", type=int, default=defaults.entities,
+                        help="Number of entities per map")
+    parser.add_argument("--tex-size", type=int, default=256,
+                        help="Width and height of textures, in pixels")
+    parser.add_argument("--seed", type=int, default=defaults.seed,
+                        help="Random seed")
+
+    return parser.parse_args(in_args)
+
+
+def main(argv):
+    args = _parse_args(argv)
+    params = SynthParams(polygons=args.polygons,
+                         patches=args.patches,
+                         meshes=args.meshes,
+                         textures=args.textures,
+                         entities=args.entities,
+                         seed=args.seed)
+    write_pk3s(args.dir, params, args.maps, args.tex_size)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -3,7 +3,11 @@ __all__ = (
     'write',
 )
 
+import collections
 import contextlib
+import itertools
+
+import emitter
 
 #@@@ Make these more general and not hardcoded.
 _OUTPUT_SIZE = (800, 600)
@@ -19,8 +23,7 @@ class _Tag():
     def opening_tag(self):
         return "<{} {}>".format(
             self.name,
-            " ".join("{}={!r}".format(k,str(v))
-                for k, v in self.params.items()))
+            " ".join(_attr_str(k, v) for k, v in self.params.items()))
         
     @property
     def closing_tag(self):
@@ -29,45 +32,92 @@ class _Tag():
     def __str__(self):
         return self.opening_tag + self.closing_tag
 
+def _attr_str(name, value):
+    # Numbers never need escaping, so skip the relatively slow `repr`.
+    if isinstance(value, (int, float)):
+        return "{}='{}'".format(name, value)
+    return "{}={!r}".format(name, str(value))
+
+_Mesh = collections.namedtuple('_Mesh',
+        ['positions', 'indices', 'material_indices', 'materials'])
+
+
+def _mesh_from_tris(tris):
+    """
+    Build a mesh object (as described in `povray.sdl`) from an iterable of
+    triangles, consuming it once.
+
+    """
+    positions = []
+    material_indices = []
+    materials = []
+    material_to_idx = {}
+    for tri in tris:
+        for point in tri:
+            positions.extend(point)
+        if tri.material.name not in material_to_idx:
+            material_to_idx[tri.material.name] = len(materials)
+            materials.append(tri.material)
+        material_indices.append(material_to_idx[tri.material.name])
+
+    return _Mesh(positions=positions,
+                 indices=range(len(positions) // 3),
+                 material_indices=material_indices,
+                 materials=materials)
+
+
+def _set_material_lines(mesh):
+    """
+    Generate a `set_material` tag for each run of faces with the same
+    material, along with the index of the run's first face.
+
+    """
+    face_idx = 0
+    for mat_idx, run in itertools.groupby(mesh.material_indices):
+        yield face_idx, str(_Tag("set_material",
+                                 sval=mesh.materials[mat_idx].name))
+        face_idx += sum(1 for _ in run)
+
+
 class _XmlWriter():
-    def __init__(self, xml_file, scene):
+    def __init__(self, xml_emitter, scene):
         self._scene = scene
-        self._xml_file = xml_file
-        self._indent = 0
+        self._emitter = xml_emitter
 
     def _output_line(self, line):
-        self._xml_file.write("  " * self._indent + str(line) + "\n")
+        self._emitter.line(str(line))
 
     def _output_lines(self, lines):
-        for line in lines:
-            self._output_line(line)
+        self._emitter.lines(str(line) for line in lines)
 
     @contextlib.contextmanager
     def _in_tag(self, tag):
         self._output_line(tag.opening_tag)
-        self._indent += 1
-        yield
-        self._indent -= 1
+        with self._emitter.indented():
+            yield
         self._output_line(tag.closing_tag)
 
     def _write_mesh(self):
-        num_tris = len(list(self._scene.tris))
+        if hasattr(self._scene, "mesh"):
+            mesh = self._scene.mesh
+        else:
+            mesh = _mesh_from_tris(self._scene.tris)
+
+        positions = mesh.positions
+        indices = mesh.indices
+        num_tris = len(mesh.material_indices)
         with self._in_tag(_Tag("mesh",
-                               vertices=(3 * num_tris),
+                               vertices=(len(positions) // 3),
                                faces=num_tris)):
-            for tri in self._scene.tris:
-                for point in tri:
-                    self._output_line(_Tag("p",
-                                      x=point[0],
-                                      y=point[1],
-                                      z=point[2]))
-
-            for idx, tri in enumerate(self._scene.tris):
-                self._output_line(_Tag("set_material", sval=tri.material.name))
-                self._output_line(_Tag("f",
-                                  a=(3 * idx),
-                                  b=(3 * idx + 1),
-                                  c=(3 * idx + 2)))
+            spec = emitter.float_spec(positions)
+            self._emitter.rows(str(_Tag("p", x=spec, y=spec, z=spec)),
+                               positions, 3)
+
+            # `set_material` applies to all subsequent faces, so only output
+            # it when the material changes.
+            face_format = str(_Tag("f", a="%d", b="%d", c="%d"))
+            self._emitter.rows(face_format, indices, 3,
+                               headers=_set_material_lines(mesh))
 
     def _write_lights(self):
         for idx, light in enumerate(self._scene.lights):
@@ -124,7 +174,7 @@ class _XmlWriter():
                                        a=1))
 
     def _write_render(self):
-        self._xml_file.write(""" 
+        self._emitter.write(""" 
 <background name="world_background">
 	<color r="0.437557" g="0.546283" b="1" a="1"/>
 	<power fval="1"/>
@@ -192,9 +242,12 @@ def write(xml_file, scene):
     """
     Write a scene to an XML file
 
+    Output is buffered, and written to `xml_file` in large chunks.
+
     """
 
-    xml_writer = _XmlWriter(xml_file, scene)
-    xml_writer.write()
+    with emitter.Emitter(xml_file) as xml_emitter:
+        xml_writer = _XmlWriter(xml_emitter, scene)
+        xml_writer.write()
 
 